@@ -1,123 +1,477 @@
 # These lines import the necessary modules and libraries for building a web API 
 # using aiohttp and configuring Cross-Origin Resource Sharing (CORS) using aiohttp_cors.
+import asyncio
+import json
 import logging
+import os
 from aiohttp import web
 import aiohttp_cors
+import todo_changes
+import todo_metrics
+from todo_input import PATCH_FIELDS, parse_page, parse_tag_query, validate_patch, validate_todo
+from todo_log import TodoLog
+from todo_replica import Replica
+from todo_store import TodoStore
 
-# This dictionary, TODOS, represents a collection of todo items. 
-# Each todo item is represented as a dictionary with keys for 'title', 'order', and 'completed'.
+# STORE holds the todo items (see todo_store.py). Each todo has a 'title', 'order',
+# 'completed' and 'tags', and a 'version' incremented by every update, which is its
+# ETag (see if_match_fails). Ids come from a counter and are never reused.
+# The encoding of every todo is cached until the todo changes, so list responses are
+# joined from ready-made fragments. TODOS_JSON_CACHE=0 disables the cache to compare
+# both paths, GET /cache/stats counts cache hits and rebuilt entries.
+USE_JSON_CACHE = os.environ.get('TODOS_JSON_CACHE', '1') != '0'
+STORE = TodoStore(json_cache=USE_JSON_CACHE)
 
-TODOS = {
-    0: {'title': 'build an API', 'order': 1, 'completed': False, 'tags':['work']},
-    1: {'title': '?????', 'order': 2, 'completed': False, 'tags': ['miscellaneous']},
-    2: {'title': 'profit!', 'order': 3, 'completed': False, 'tags': ['work','social']}
-}
+for todo in [
+    {'title': 'build an API', 'order': 1, 'completed': False, 'tags':['work']},
+    {'title': '?????', 'order': 2, 'completed': False, 'tags': ['miscellaneous']},
+    {'title': 'profit!', 'order': 3, 'completed': False, 'tags': ['work','social']}
+]:
+    STORE.create(todo)
+
+def todo_url(request, id):
+    return str(request.url.join(request.app.router['one_todo'].url_for(id=str(id))))
+
+# Return a function encoding todos for this request: the cached encoding of the todo
+# followed by its url.
+def todo_encoder(request):
+    url_prefix = json.dumps(todo_url(request, 0)[:-1]).encode()[:-1]
+    return lambda id: STORE.encode(id) + b', "url": ' + url_prefix + str(id).encode() + b'"}'
+
+# Lists are paginated by id (see todo_input.py). Without a limit the whole list is
+# streamed in chunks instead of being built as one big response.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Write a JSON array from already encoded items to a chunked response, one chunk
+# every STREAM_CHUNK_SIZE bytes.
+async def stream_json_array(request, fragments):
+    response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    chunk, size = [b'['], 1
+    for i, encoded in enumerate(fragments):
+        chunk.append(encoded if i == 0 else b', ' + encoded)
+        size += len(encoded) + 2
+        if size >= STREAM_CHUNK_SIZE:
+            await response.write(b''.join(chunk))
+            chunk, size = [], 0
+    chunk.append(b']')
+    await response.write(b''.join(chunk))
+    await response.write_eof()
+    return response
+
+# Answer a list request: one page with a "next" Link header when a limit is given, the
+# whole list streamed otherwise. `select(after, count)` returns the ids after the cursor
+# in ascending order, at most `count` of them (all of them with None).
+async def list_todos(request, select):
+    limit, after = parse_page(request)
+    encode_todo = todo_encoder(request)
+
+    if limit is None:
+        # The ids are a copy because the todos can change while the response is written.
+        return await stream_json_array(request, (
+            encode_todo(key) for key in select(after, None) if key in STORE
+        ))
+
+    page = select(after, limit + 1)
+    headers = {}
+    if len(page) > limit:
+        page = page[:limit]
+        next_url = request.url.update_query(after=str(page[-1]), limit=str(limit))
+        headers['Link'] = f'<{next_url}>; rel="next"'
+    body = b'[' + b', '.join(encode_todo(key) for key in page) + b']'
+    return web.Response(body=body, content_type='application/json', headers=headers)
 
 # This function, get_all_todos, is a request handler that returns a JSON response 
-# containing a list of all todo items. It converts the TODOS dictionary into a list of dictionaries, adding an 'id' key to each item.
-def get_all_todos(request):
-    return web.json_response([
-        {'id': key, **todo} for key, todo in TODOS.items()
-    ])
+# containing a list of all todo items, adding an 'id' and a 'url' key to each item.
+# With "?tags=a,b" only the todos having any of the tags are returned ("&match=all" for all of them).
+async def get_all_todos(request):
+    tags, match = parse_tag_query(request)
+    if tags is not None:
+        return await list_todos(request, lambda after, count: STORE.ids_for_tags(tags, match, after, count))
+    return await list_todos(request, STORE.ids_after)
 
 # This function, remove_all_todos, is a request handler that clears all todo items by emptying 
-# the TODOS dictionary and returns a successful response with HTTP status code 204 (No Content).
+# the store and returns a successful response with HTTP status code 204 (No Content).
 
-def remove_all_todos(request):
-    TODOS.clear()
+async def remove_all_todos(request):
+    await synced(clear_todos())
     return web.Response(status=204)
 
-# This function, get_one_todo, retrieves a single todo item by its ID from the TODOS dictionary.
+# This function, get_one_todo, retrieves a single todo item by its ID from the store.
 # It first extracts the ID from the request's URL parameters.
-# If the ID is not found in the TODOS dictionary, it returns a JSON response with an error message and a 404 status code. Otherwise, it returns the specified todo item as a JSON response.
+# If the ID is not found in the store, it returns a JSON response with an error message and a 404 status code. Otherwise, it returns the specified todo item as a JSON response.
 def get_one_todo(request):
     id = int(request.match_info['id'])
 
-    if id not in TODOS:
+    if id not in STORE:
         return web.json_response({'error': 'Todo not found'}, status=404)
 
-    return web.json_response({'id': id, **TODOS[id]})
+    etag = todo_etag(id)
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers={'ETag': etag})
+    body = todo_encoder(request)(id)
+    return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
 
-# This asynchronous function, create_todo, is used to create a new todo item
-async def create_todo(request):
-    data = await request.json()
+def todo_etag(id):
+    return f'"v{STORE[id].version}"'
+
+# Check the If-Match header of a request against the current version of a todo, so
+# that concurrent editors get a 412 instead of overwriting each other's changes.
+def if_match_fails(request, id):
+    header = request.headers.get('If-Match')
+    if header is None or header.strip() == '*':
+        return False
+    return todo_etag(id) not in [candidate.strip() for candidate in header.split(',')]
+
+def precondition_failed():
+    return web.json_response({'error': 'Todo was modified, If-Match does not match its version'}, status=412)
 
-    if 'title' not in data:
-        return web.json_response({'error': '"title" is a required field'})
-    title = data['title']
-    if not isinstance(title, str) or not len(title):
-        return web.json_response({'error': '"title" must be a string with at least one character'})
+# The changes to the store are made by apply_record, called by the handlers through
+# add_todo, patch_todo, delete_todo and clear_todos, which also log them when
+# persistence is enabled, and by the recovery of the log at startup.
+def apply_record(record):
+    if record['op'] == 'create':
+        STORE.insert(record['id'], record['todo'])
+    elif record['op'] == 'patch':
+        STORE.patch(record['id'], record['fields'])
+    elif record['op'] == 'delete':
+        STORE.delete(record['id'])
+    elif record['op'] == 'clear':
+        STORE.clear()
 
-    # add for tags part. I did it here in create todo
-    tags = data.get('tags', [])
-    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
-        return web.json_response({'error': '"tags" must be a list of strings'})
+# Log a change that was just applied and send it to the replicas. Returns a future
+# resolved once the change is on disk, or None without persistence.
+def log_change(record):
+    global CHANGE_SEQ
+    CHANGE_SEQ += 1
+    for queue in list(REPLICAS):
+        try:
+            queue.put_nowait((CHANGE_SEQ, record))
+        except asyncio.QueueFull:
+            drop_replica(queue)
+    if FEED is not None:
+        FEED.publish(change_event(record), CHANGE_SEQ)
+    if TODO_LOG is None:
+        return None
+    return TODO_LOG.append(record)
 
-    data['completed'] = bool(data.get('completed', False))
-    data['tags'] = tags  # Set the tags field based on the input.
+# The event sent to the change feed for a change record (see todo_changes.py). Created
+# todos are sent whole but without their url, which depends on the request of each
+# client, updates with the fields changed and the new version.
+def change_event(record):
+    if record['op'] == 'create':
+        return {'op': 'create', 'id': record['id'], 'todo': STORE.to_dict(record['id'])}
+    if record['op'] == 'patch':
+        return {'op': 'update', 'id': record['id'], 'fields': record['fields'],
+                'version': STORE[record['id']].version}
+    return record
 
-    new_id = max(TODOS.keys(), default=0) + 1
-    data['url'] = str(request.url.join(request.app.router['one_todo'].url_for(id=str(new_id))))
+# Wait until a logged change is on disk, the handlers answer only after that.
+async def synced(future):
+    if future is not None:
+        await future
 
-    TODOS[new_id] = data
+# Store a validated new todo. Returns its id and the future of its log record.
+def add_todo(data):
+    fields = {key: data[key] for key in PATCH_FIELDS if key in data}
+    fields['completed'] = bool(data.get('completed', False))
+
+    new_id = STORE.create(fields)
+    return new_id, log_change({'op': 'create', 'id': new_id, 'todo': fields})
+
+# Apply a validated patch to an existing todo.
+def patch_todo(id, data):
+    fields = {key: data[key] for key in PATCH_FIELDS if key in data}
+    STORE.patch(id, fields)
+    return log_change({'op': 'patch', 'id': id, 'fields': fields})
+
+def delete_todo(id):
+    STORE.delete(id)
+    return log_change({'op': 'delete', 'id': id})
+
+def clear_todos():
+    STORE.clear()
+    return log_change({'op': 'clear'})
+
+# This asynchronous function, create_todo, is used to create a new todo item
+async def create_todo(request):
+    data = await request.json()
+
+    error = validate_todo(data)
+    if error:
+        return web.json_response({'error': error})
+
+    new_id, logged = add_todo(data)
+    await synced(logged)
 
     return web.Response(
-        headers={'Location': data['url']},
+        headers={'Location': todo_url(request, new_id)},
         status=303
     )
 # update todo
 async def update_todo(request):
     id = int(request.match_info['id'])
 
-    if id not in TODOS:
+    if id not in STORE:
         return web.json_response({'error': 'Todo not found'}, status=404)
 
     data = await request.json()
-    TODOS[id].update(data)
+    # The todo can have been deleted while the body was read
+    if id not in STORE:
+        return web.json_response({'error': 'Todo not found'}, status=404)
+    error = validate_patch(data)
+    if error:
+        return web.json_response({'error': error})
+    if if_match_fails(request, id):
+        return precondition_failed()
 
-    return web.json_response(TODOS[id])
+    # Only the fields listed in PATCH_FIELDS are changed. The answer is built before
+    # waiting for the log, the todo can be deleted meanwhile.
+    logged = patch_todo(id, data)
+    todo = {**STORE.to_dict(id), 'url': todo_url(request, id)}
+    etag = todo_etag(id)
+    await synced(logged)
+    return web.json_response(todo, headers={'ETag': etag})
 # remove todo
-def remove_todo(request):
+async def remove_todo(request):
     id = int(request.match_info['id'])
 
-    if id not in TODOS:
+    if id not in STORE:
         return web.json_response({'error': 'Todo not found'})
+    if if_match_fails(request, id):
+        return precondition_failed()
 
-    del TODOS[id]
+    await synced(delete_todo(id))
 
     return web.Response(status=204)
+# Create, patch and delete many todos in one request. The body is a list of operations:
+#   {"op": "create", "data": {...}}, {"op": "patch", "id": 1, "data": {...}}, {"op": "delete", "id": 1}
+# They are applied in order and the response lists the result of each one.
+async def bulk_todos(request):
+    try:
+        items = await request.json()
+    except ValueError:
+        return web.json_response({'error': 'Invalid JSON format in request body'}, status=400)
+    if not isinstance(items, list):
+        return web.json_response({'error': 'the body must be a list of operations'}, status=400)
+
+    results = []
+    logged = None
+    for item in items:
+        op = item.get('op') if isinstance(item, dict) else None
+        id = item.get('id') if isinstance(item, dict) else None
+        if op not in ('create', 'patch', 'delete'):
+            results.append({'status': 400, 'error': '"op" must be "create", "patch" or "delete"'})
+        elif op == 'create':
+            error = validate_todo(item.get('data'))
+            if error:
+                results.append({'status': 400, 'error': error})
+                continue
+            new_id, logged = add_todo(item['data'])
+            results.append({'status': 201, 'id': new_id, 'url': todo_url(request, new_id)})
+        elif not isinstance(id, int) or isinstance(id, bool) or id not in STORE:
+            results.append({'status': 404, 'id': id, 'error': 'Todo not found'})
+        elif op == 'patch':
+            error = validate_patch(item.get('data'))
+            if error:
+                results.append({'status': 400, 'id': id, 'error': error})
+                continue
+            logged = patch_todo(id, item['data'])
+            results.append({'status': 200, 'id': id, 'url': todo_url(request, id)})
+        else:
+            logged = delete_todo(id)
+            results.append({'status': 204, 'id': id})
+
+    # Log records are written in order, so the last one being on disk covers all of them
+    await synced(logged)
+
+    return web.json_response(results)
+
 # Add an Endpoint to Get Todos by Tag
-def get_todos_by_tag(request):
+async def get_todos_by_tag(request):
     tag = request.match_info['tag']
-    todos_with_tag = [{'id': key, **todo} for key, todo in TODOS.items() if tag in todo.get('tags', [])]
-
-    return web.json_response(todos_with_tag)
-
-#These lines configure CORS (Cross-Origin Resource Sharing) settings for the aiohttp 
-# application. It sets up CORS to allow cross-origin requests for various routes defined in the application.
-
-app = web.Application()
-
-# Configure default CORS settings.
-cors = aiohttp_cors.setup(app, defaults={
-    "*": aiohttp_cors.ResourceOptions(
-            allow_credentials=True,
-            expose_headers="*",
-            allow_headers="*",
-            allow_methods="*",
-        )
-})
-
-cors.add(app.router.add_get('/todos/', get_all_todos, name='all_todos'))
-cors.add(app.router.add_delete('/todos/', remove_all_todos, name='remove_todos'))
-cors.add(app.router.add_post('/todos/', create_todo, name='create_todo'))
-cors.add(app.router.add_get('/todos/{id:\d+}', get_one_todo, name='one_todo'))
-cors.add(app.router.add_patch('/todos/{id:\d+}', update_todo, name='update_todo'))
-cors.add(app.router.add_delete('/todos/{id:\d+}', remove_todo, name='remove_todo'))
-# route to retrive todo by tag. for exemple /todos/tag/work
-cors.add(app.router.add_get('/todos/tag/{tag}', get_todos_by_tag, name='todos_by_tag'))
-# This code sets up basic logging and runs the aiohttp web application on port 8081.
 
-logging.basicConfig(level=logging.DEBUG)
-web.run_app(app, port=8081)
+    return await list_todos(request, lambda after, count: STORE.ids_for_tags([tag], 'any', after, count))
+
+# Report how often list and detail responses were served from the encoded todos cache.
+def get_cache_stats(request):
+    return web.json_response({'enabled': USE_JSON_CACHE, 'size': len(STORE.encoded), **STORE.cache_stats})
+
+# Persistence: with TODOS_DATA_DIR set, every change is logged to that directory and
+# the todos are recovered from it at startup (see todo_log.py). The log is compacted
+# into a snapshot once it reaches TODOS_LOG_COMPACT_BYTES.
+DATA_DIR = os.environ.get('TODOS_DATA_DIR')
+LOG_COMPACT_BYTES = int(os.environ.get('TODOS_LOG_COMPACT_BYTES', str(64 * 1024 * 1024)))
+TODO_LOG = None
+
+async def init_log(app):
+    global TODO_LOG
+    if DATA_DIR is None:
+        return
+    TODO_LOG = TodoLog(DATA_DIR, STORE.snapshot, LOG_COMPACT_BYTES)
+    state, records = TODO_LOG.recover()
+    if state is not None:
+        STORE.restore(state)
+    for record in records:
+        apply_record(record)
+    TODO_LOG.start()
+    # The first run starts from the todos defined above, saved as the first snapshot
+    if state is None:
+        await TODO_LOG.compact()
+
+async def close_log(app):
+    if TODO_LOG is not None:
+        await TODO_LOG.close()
+
+# Report how many changes were logged and fsynced, and the size of the log.
+def get_log_stats(request):
+    if TODO_LOG is None:
+        return web.json_response({'enabled': False})
+    return web.json_response({'enabled': True, **TODO_LOG.stats()})
+
+# Replication: when runner.py serves this backend from several worker processes, one
+# owner process holds the todos and makes every change, and the workers keep replicas
+# of them (see todo_replica.py). CHANGE_SEQ counts the changes made by this process and
+# REPLICAS maps one queue of changes per connected worker to its connection. A worker
+# more than TODOS_REPLICA_QUEUE changes behind (default 100000) is disconnected: it
+# stops, and the runner starts a new one that loads the todos again.
+CHANGE_SEQ = 0
+REPLICAS = {}
+REPLICA_QUEUE_SIZE = int(os.environ.get('TODOS_REPLICA_QUEUE', '100000'))
+# The changes are also streamed to clients by GET /todos/_changes, numbered by CHANGE_SEQ.
+# The feed is made by create_app, in the process serving it: runner.py imports this
+# module before forking, and a feed made here would give every process, restarted ones
+# included, the same epoch.
+FEED = None
+
+# Stream the todos to a worker, then every change made after them, one JSON line each.
+async def get_replication(request):
+    # The snapshot is taken and the queue registered at the same time, so that no change
+    # is missing or sent twice.
+    snapshot = STORE.snapshot()
+    queue = asyncio.Queue(REPLICA_QUEUE_SIZE)
+    REPLICAS[queue] = request.transport
+    try:
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        header = {'seq': CHANGE_SEQ, 'epoch': FEED.epoch, 'next_id': snapshot['next_id'], 'count': len(snapshot['todos'])}
+        lines = [json.dumps(header)] + [json.dumps(todo) for todo in snapshot['todos']]
+        for start in range(0, len(lines), 1000):
+            await response.write(('\n'.join(lines[start:start + 1000]) + '\n').encode())
+        while True:
+            changes = [await queue.get()]
+            while not queue.empty():
+                changes.append(queue.get_nowait())
+            if None in changes:
+                return response
+            await response.write(''.join(
+                json.dumps({'seq': seq, **record}) + '\n' for seq, record in changes
+            ).encode())
+    except ConnectionError:
+        # The worker went away, or was dropped for falling behind
+        return response
+    finally:
+        REPLICAS.pop(queue, None)
 
+# Disconnect a worker whose queue is full. Its stream is ended whether the handler
+# waits for changes or for the worker to read the ones already sent.
+def drop_replica(queue):
+    transport = REPLICAS.pop(queue)
+    logging.warning('A worker fell %d changes behind, disconnecting it', queue.qsize())
+    end_replica(queue)
+    if transport is not None:
+        transport.abort()
+
+def end_replica(queue):
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+# End the replication streams when the server stops, instead of waiting for them.
+async def close_replicas(app):
+    for queue in REPLICAS:
+        end_replica(queue)
+
+# A worker's change feed continues the owner's: same sequence numbers and event ids, so
+# that a client can resume from any worker, as far as that worker's buffer goes.
+def restore_replica(snapshot):
+    STORE.restore(snapshot)
+    FEED.reset(snapshot['seq'], snapshot['epoch'])
+
+def replicate(record):
+    apply_record(record)
+    FEED.publish(change_event(record), record['seq'])
+
+# End the change feed streams when the server stops.
+async def close_feed(app):
+    FEED.close()
+
+# Writes answer with the sequence of the last change made, the worker that forwarded
+# the request waits for its replica to reach it before answering the client.
+@web.middleware
+async def change_seq_header(request, handler):
+    response = await handler(request)
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        response.headers['X-Todos-Seq'] = str(CHANGE_SEQ)
+    return response
+
+# Build the application. By default this process holds the todos. With owner, it is
+# the owner of runner.py, listening on a unix socket only, and also streams the todos
+# to the workers on GET /_replication. With owner_socket, it is a worker serving a
+# replica of the todos of the owner listening on that unix socket, and forwarding the
+# writes to it.
+def create_app(owner_socket=None, owner=False):
+    global FEED
+    FEED = todo_changes.ChangeFeed()
+    if owner_socket is None:
+        app = web.Application(middlewares=[
+            todo_metrics.request_metrics, todo_metrics.profile_requests, change_seq_header])
+        app.on_startup.append(init_log)
+        app.on_cleanup.append(close_log)
+        if owner:
+            app.on_shutdown.append(close_replicas)
+            app.router.add_get('/_replication', get_replication, name='replication')
+    else:
+        replica = Replica(owner_socket, restore_replica, replicate)
+        app = web.Application(middlewares=[
+            todo_metrics.request_metrics, todo_metrics.profile_requests, replica.forward_writes])
+        app.on_startup.append(replica.start)
+        app.on_shutdown.append(replica.stop)
+        app.on_cleanup.append(replica.close)
+    app['changes'] = FEED
+    app.on_shutdown.append(close_feed)
+
+    #These lines configure CORS (Cross-Origin Resource Sharing) settings for the aiohttp
+    # application. It sets up CORS to allow cross-origin requests for various routes defined in the application.
+    cors = aiohttp_cors.setup(app, defaults={
+        "*": aiohttp_cors.ResourceOptions(
+                allow_credentials=True,
+                expose_headers="*",
+                allow_headers="*",
+                allow_methods="*",
+            )
+    })
+
+    cors.add(app.router.add_get('/todos/', get_all_todos, name='all_todos'))
+    cors.add(app.router.add_delete('/todos/', remove_all_todos, name='remove_todos'))
+    cors.add(app.router.add_post('/todos/', create_todo, name='create_todo'))
+    cors.add(app.router.add_post('/todos/_bulk', bulk_todos, name='bulk_todos'))
+    cors.add(app.router.add_get('/todos/{id:\d+}', get_one_todo, name='one_todo'))
+    cors.add(app.router.add_patch('/todos/{id:\d+}', update_todo, name='update_todo'))
+    cors.add(app.router.add_delete('/todos/{id:\d+}', remove_todo, name='remove_todo'))
+    # Create, update and delete events, see todo_changes.py
+    cors.add(app.router.add_get('/todos/_changes', todo_changes.get_changes, name='todo_changes'))
+    # route to retrive todo by tag. for exemple /todos/tag/work
+    cors.add(app.router.add_get('/todos/tag/{tag}', get_todos_by_tag, name='todos_by_tag'))
+    cors.add(app.router.add_get('/cache/stats', get_cache_stats, name='cache_stats'))
+    cors.add(app.router.add_get('/log/stats', get_log_stats, name='log_stats'))
+    app.router.add_get('/metrics', todo_metrics.get_metrics, name='metrics')
+    return app
+
+# This code sets up basic logging and runs the aiohttp web application on port 8081.
+# runner.py imports create_app to serve it from several processes. The log level is
+# TODOS_LOG_LEVEL (default INFO), and the access log is sampled.
+if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('TODOS_LOG_LEVEL', 'INFO'))
+    web.run_app(create_app(), port=8081, access_log_class=todo_metrics.SampledAccessLogger)
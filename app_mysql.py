@@ -1,25 +1,526 @@
 # These lines import the necessary modules and libraries for building a web API
 # using aiohttp and configuring Cross-Origin Resource Sharing (CORS) using aiohttp_cors. And using aiomysql for mysql as i choose mysql for my project (pip install aiomysql)
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
 import logging
+import os
+import re
+import time
 from aiohttp import web
 import aiohttp_cors
 import aiomysql
+from pymysql.constants import CLIENT
+import todo_changes
+import todo_metrics
+from todo_input import (
+    PATCH_FIELDS,
+    parse_page,
+    parse_tag_query,
+    validate_patch,
+    validate_todo,
+)
+
+# Database and pool settings. Every value can be overridden with an environment
+# variable so the pool can be sized per deployment without touching the code.
+DB_CONFIG = {
+    "host": os.environ.get("TODOS_DB_HOST", "localhost"),
+    "port": int(os.environ.get("TODOS_DB_PORT", "3306")),
+    "user": os.environ.get("TODOS_DB_USER", "root"),
+    "password": os.environ.get("TODOS_DB_PASSWORD", ""),
+    "db": os.environ.get("TODOS_DB_NAME", "todos_app"),
+}
+POOL_MINSIZE = int(os.environ.get("TODOS_POOL_MINSIZE", "1"))
+POOL_MAXSIZE = int(os.environ.get("TODOS_POOL_MAXSIZE", "10"))
+# Connections older than this many seconds are closed and reopened (-1 disables it).
+POOL_RECYCLE = int(os.environ.get("TODOS_POOL_RECYCLE", "3600"))
+# How long a request waits for a free connection before answering 503.
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get("TODOS_POOL_ACQUIRE_TIMEOUT", "5"))
+
+# Every statement is timed by the cursor classes below, labelled with its verb and
+# table ("SELECT todos"). The time spent waiting for a pool connection is recorded
+# too, and both are served by GET /metrics (see todo_metrics.py).
+QUERY_SECONDS = todo_metrics.REGISTRY.histogram(
+    "todos_db_query_duration_seconds", "Time to run a statement.", ("statement",)
+)
+POOL_WAIT_SECONDS = todo_metrics.REGISTRY.histogram(
+    "todos_db_pool_wait_seconds", "Time waited for a database connection."
+)
+POOL_CONNECTIONS = todo_metrics.REGISTRY.gauge(
+    "todos_db_pool_connections_in_use", "Connections of the pool lent to requests."
+)
+TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.I)
+
+
+def statement_name(query):
+    verb = query.split(None, 1)[0].upper() if query.strip() else "OTHER"
+    table = TABLE_PATTERN.search(query)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+class TimedCursorMixin:
+    async def execute(self, query, args=None):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, args)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, statement_name(query))
+
 
-# connect to database mysql
+class TimedCursor(TimedCursorMixin, aiomysql.Cursor):
+    pass
 
 
+class TimedDictCursor(TimedCursorMixin, aiomysql.DictCursor):
+    pass
+
+
+# With an unbuffered cursor, the time of execute() only covers the first rows.
+class TimedSSDictCursor(TimedCursorMixin, aiomysql.SSDictCursor):
+    pass
+
+
+# connect to database mysql. The pool is created once when the application starts
+# and closed when it shuts down, all handlers share it through request.app["pool"].
+# With FOUND_ROWS, the rowcount of an UPDATE is the number of matched rows, so it
+# also tells whether the todo exists when nothing had to change.
 async def create_pool():
     pool = await aiomysql.create_pool(
-        host="localhost",
-        port=3306,
-        user="root",
-        password="",
-        db="todos_app",
+        minsize=POOL_MINSIZE,
+        maxsize=POOL_MAXSIZE,
+        pool_recycle=POOL_RECYCLE,
         autocommit=True,
+        client_flag=CLIENT.FOUND_ROWS,
+        cursorclass=TimedCursor,
+        **DB_CONFIG,
     )
     return pool
 
 
+async def init_pool(app):
+    app["pool"] = await create_pool()
+    app["pool_waiters"] = 0
+
+
+async def close_pool(app):
+    app["pool"].close()
+    await app["pool"].wait_closed()
+
+
+# Borrow a connection from the application pool. Requests that cannot get one
+# within POOL_ACQUIRE_TIMEOUT seconds get a 503 instead of queueing forever.
+@contextlib.asynccontextmanager
+async def acquire(app):
+    pool = app["pool"]
+    app["pool_waiters"] += 1
+    start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise web.HTTPServiceUnavailable(
+            text='{"error": "No database connection available"}',
+            content_type="application/json",
+        )
+    finally:
+        app["pool_waiters"] -= 1
+        POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+    POOL_CONNECTIONS.inc()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+        POOL_CONNECTIONS.dec()
+
+
+# Run the statements of the block in one transaction, rolled back if anything fails.
+# The pool runs in autocommit mode, so multi-statement writes must go through this.
+@contextlib.asynccontextmanager
+async def transaction(conn):
+    await conn.begin()
+    try:
+        yield
+    except BaseException:
+        await conn.rollback()
+        raise
+    await conn.commit()
+
+
+# Read responses are kept in a bounded LRU cache of encoded bodies and carry an ETag,
+# so polling clients get a 304 or a cached body without touching the database.
+# Every write bumps a collection version and the version of the todo it changed,
+# and drops exactly the cache entries it affects. The TTL bounds how long changes
+# made to the database by other programs can go unnoticed.
+CACHE_MAX_ENTRIES = int(os.environ.get("TODOS_CACHE_MAX_ENTRIES", "1024"))
+CACHE_MAX_BYTES = int(os.environ.get("TODOS_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CACHE_MAX_ENTRY_BYTES = int(
+    os.environ.get("TODOS_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024))
+)
+CACHE_TTL = float(os.environ.get("TODOS_CACHE_TTL", "30"))
+CACHE_MAX_VERSIONS = int(os.environ.get("TODOS_CACHE_MAX_VERSIONS", "65536"))
+
+# ids are the todos the response contains, tags the tags it was filtered on (None for
+# the unfiltered list). Both decide which writes invalidate the entry.
+CacheEntry = collections.namedtuple("CacheEntry", "etag body headers ids tags expires")
+
+
+class ResponseCache:
+    def __init__(self, max_entries, max_bytes, max_entry_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires < time.monotonic():
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, etag, body, headers, ids, tags):
+        if len(body) > self.max_entry_bytes:
+            return
+        self.remove(key)
+        expires = time.monotonic() + self.ttl
+        self.entries[key] = CacheEntry(etag, body, headers, ids, tags, expires)
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    # Drop the entries a write to todo `id`, now tagged with `tags`, can change: the
+    # unfiltered lists, the responses containing the todo and the lists filtered on
+    # one of its new tags.
+    def invalidate(self, id, tags):
+        for key, entry in list(self.entries.items()):
+            if entry.tags is None or id in entry.ids or not entry.tags.isdisjoint(tags):
+                self.remove(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+# Last known version column of the todos read or written by this process. A version is
+# only trusted for `ttl` seconds, like a cached response, so that the changes made to
+# the database by other programs are seen by conditional requests too. At most
+# `max_entries` versions are kept, the least recently used are dropped first.
+class KnownVersions:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def get(self, id):
+        entry = self.entries.get(id)
+        if entry is None:
+            return None
+        version, expires = entry
+        if expires < time.monotonic():
+            del self.entries[id]
+            return None
+        self.entries.move_to_end(id)
+        return version
+
+    def set(self, id, version):
+        self.entries[id] = (version, time.monotonic() + self.ttl)
+        self.entries.move_to_end(id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def discard(self, id):
+        self.entries.pop(id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+# The cache and the versions only see the writes made by this process. When several
+# processes serve the same database (see runner.py), create_app(process_cache=False)
+# turns off the cache and the answers based on versions known in memory; single todos
+# still get a 304 when the version read from the database matches.
+async def init_cache(app):
+    if app["process_cache"]:
+        app["cache"] = ResponseCache(
+            CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_MAX_ENTRY_BYTES, CACHE_TTL
+        )
+        app["todo_versions"] = KnownVersions(CACHE_MAX_VERSIONS, CACHE_TTL)
+    else:
+        app["cache"] = ResponseCache(0, 0, 0, 0)
+        app["todo_versions"] = KnownVersions(0, 0)
+    # Part of every collection ETag, so tags handed out before a restart or by another
+    # process never match.
+    app["boot_id"] = os.urandom(4).hex()
+    app["collection_version"] = 0
+    app["collection_expires"] = time.monotonic() + CACHE_TTL
+    app["not_modified"] = 0
+
+
+# The collection ETag changes with every write of this process, and at least every
+# CACHE_TTL seconds, so that a client polling with If-None-Match sees the changes made
+# by other programs as late as a cached response would.
+def collection_etag(app):
+    if not app["process_cache"]:
+        return None
+    now = time.monotonic()
+    if now >= app["collection_expires"]:
+        app["collection_version"] += 1
+        app["collection_expires"] = now + CACHE_TTL
+    return f'"{app["boot_id"]}-{app["collection_version"]}"'
+
+
+def etag_header(etag):
+    return {"ETag": etag} if etag is not None else {}
+
+
+# The ETag of a todo is its version column, so it is also valid across processes
+# and can be sent back in If-Match.
+def todo_etag(version):
+    return f'"v{version}"'
+
+
+# Called by the write handlers once their changes are committed, with the new version
+# of the todo (None when it was deleted). Without an id every todo is considered changed.
+def record_write(app, id=None, tags=(), version=None):
+    app["collection_version"] += 1
+    if id is None:
+        app["todo_versions"].clear()
+        app["cache"].clear()
+    else:
+        if version is None:
+            app["todo_versions"].discard(id)
+        else:
+            app["todo_versions"].set(id, version)
+        app["cache"].invalidate(id, tags)
+
+
+# Send a committed change to the change feed (see todo_changes.py). Like the cache, the
+# feed only sees the writes of this process: create_app(process_cache=False) has none,
+# and GET /todos/_changes answers 501.
+def publish_change(app, event):
+    if app["changes"] is not None:
+        app["changes"].publish(event)
+
+
+# The written fields as a row read back would give them, so that clients get one shape
+# per todo: tags comma-joined and completed as 0 or 1.
+def row_fields(data):
+    fields = {key: data[key] for key in PATCH_FIELDS if key in data}
+    if "tags" in fields:
+        fields["tags"] = ",".join(fields["tags"])
+    if "completed" in fields:
+        fields["completed"] = int(fields["completed"])
+    return fields
+
+
+# The event of a created todo, with the values given to the missing fields.
+def created_event(id, data):
+    todo = {"id": id, "title": "", "order": 1, "completed": 0, "tags": "", "version": 1}
+    todo.update(row_fields(data))
+    return {"op": "create", "id": id, "todo": todo}
+
+
+def updated_event(id, data, version):
+    return {"op": "update", "id": id, "fields": row_fields(data), "version": version}
+
+
+def etag_matches(request, etag):
+    header = request.headers.get("If-None-Match")
+    if header is None or etag is None:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in candidates or "W/" + etag in candidates
+
+
+# Read the versions listed in the If-Match header. Returns None without a header or
+# for "*", and an empty list when no listed ETag can match a version.
+def parse_if_match(request):
+    header = request.headers.get("If-Match")
+    if header is None or header.strip() == "*":
+        return None
+    versions = []
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith('"v') and candidate.endswith('"'):
+            if candidate[2:-1].isdigit():
+                versions.append(int(candidate[2:-1]))
+    return versions
+
+
+def not_modified(request, etag):
+    request.app["not_modified"] += 1
+    return web.Response(status=304, headers={"ETag": etag})
+
+
+def cached_response(entry):
+    return web.Response(
+        body=entry.body,
+        content_type="application/json",
+        headers={"ETag": entry.etag, **entry.headers},
+    )
+
+
+# Store a response unless a write happened since the read started at `version`, in
+# which case the body may already be stale.
+def store_response(request, version, key, etag, body, headers, ids, tags):
+    if request.app["collection_version"] == version:
+        request.app["cache"].put(key, etag, body, headers, ids, tags)
+
+
+# Tags are stored twice: as the comma-joined todos.tags column returned to clients
+# and as one (tag, todo_id) row per tag in the indexed todo_tags table used for
+# lookups (see migrations/001_todo_tags.sql).
+async def replace_tags(cur, id, tags):
+    await cur.execute("DELETE FROM todo_tags WHERE todo_id = %s", (id,))
+    if tags:
+        await cur.executemany(
+            "INSERT INTO todo_tags (todo_id, tag) VALUES (%s, %s)",
+            [(id, tag) for tag in dict.fromkeys(tags)],
+        )
+
+
+# Lists are paginated by id (see todo_input.py). Without a limit the whole list is
+# streamed from an unbuffered server-side cursor, so memory use does not depend on the
+# size of the table.
+STREAM_FETCH_SIZE = 500
+
+
+# Build the query listing the todos in id order after the given id. With tags, only
+# the todos having any (match=any) or all (match=all) of them are selected, once each.
+# The todo_tags rows are read in (tag, todo_id) primary key order from the cursor on,
+# and at most `limit` of them per tag, so a page does not read every matching row.
+def select_todos(tags=None, match="any", after=-1, limit=None):
+    params = []
+    query = "SELECT t.* FROM todos t"
+    page, page_params = ("", []) if limit is None else (" LIMIT %s", [limit])
+    if tags is not None:
+        if match == "all":
+            # Walk the rows of the first tag, keeping the todos having the others too
+            matching = (
+                "SELECT todo_id FROM todo_tags tt WHERE tt.tag = %s AND tt.todo_id > %s"
+            )
+            params.extend([tags[0], after])
+            for tag in tags[1:]:
+                matching += (
+                    " AND EXISTS (SELECT 1 FROM todo_tags o"
+                    " WHERE o.tag = %s AND o.todo_id = tt.todo_id)"
+                )
+                params.append(tag)
+            matching += f" ORDER BY tt.todo_id{page}"
+            params.extend(page_params)
+        else:
+            # The first ids of every tag, merged by UNION into one row per todo
+            parts = []
+            for index, tag in enumerate(tags):
+                parts.append(
+                    f"SELECT todo_id FROM (SELECT todo_id FROM todo_tags"
+                    f" WHERE tag = %s AND todo_id > %s ORDER BY todo_id{page}) p{index}"
+                )
+                params.extend([tag, after, *page_params])
+            matching = " UNION ".join(parts)
+        query += f" JOIN ({matching}) m ON m.todo_id = t.id ORDER BY t.id"
+    else:
+        query += " WHERE t.id > %s ORDER BY t.id"
+        params.append(after)
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+# Answer a list request: one page with a "next" Link header when a limit is given,
+# otherwise the whole list written as a chunked JSON array while it is read.
+async def list_todos(request, tags=None, match="any"):
+    limit, after = parse_page(request)
+    app = request.app
+    tag_set = None if tags is None else frozenset(tags)
+    key = ("list", tag_set, match, after, limit)
+
+    etag = collection_etag(app)
+    if etag_matches(request, etag):
+        return not_modified(request, etag)
+    entry = app["cache"].get(key)
+    if entry is not None:
+        if etag_matches(request, entry.etag):
+            return not_modified(request, entry.etag)
+        return cached_response(entry)
+    version = app["collection_version"]
+
+    if tags == []:
+        return web.json_response([], headers=etag_header(etag))
+
+    if limit is not None:
+        async with acquire(app) as conn:
+            async with conn.cursor(TimedDictCursor) as cur:
+                await cur.execute(*select_todos(tags, match, after, limit + 1))
+                page = await cur.fetchall()
+        ids = frozenset(row["id"] for row in page)
+        headers = {}
+        if len(page) > limit:
+            page = page[:limit]
+            next_url = request.url.update_query(
+                after=str(page[-1]["id"]), limit=str(limit)
+            )
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        body = json.dumps(page).encode()
+        store_response(request, version, key, etag, body, headers, ids, tag_set)
+        return web.Response(
+            body=body,
+            content_type="application/json",
+            headers={**etag_header(etag), **headers},
+        )
+
+    # The streamed body is also kept for the cache as long as it stays small enough.
+    response = web.StreamResponse(
+        headers={"Content-Type": "application/json", **etag_header(etag)}
+    )
+    response.enable_chunked_encoding()
+    kept, kept_size, ids = [b"["], 1, set()
+    async with acquire(app) as conn:
+        async with conn.cursor(TimedSSDictCursor) as cur:
+            await cur.execute(*select_todos(tags, match, after))
+            await response.prepare(request)
+            await response.write(b"[")
+            separator = ""
+            while True:
+                rows = await cur.fetchmany(STREAM_FETCH_SIZE)
+                if not rows:
+                    break
+                chunk = (
+                    separator + ", ".join(json.dumps(row) for row in rows)
+                ).encode()
+                await response.write(chunk)
+                separator = ", "
+                if kept is not None:
+                    kept.append(chunk)
+                    kept_size += len(chunk)
+                    ids.update(row["id"] for row in rows)
+                    if kept_size > CACHE_MAX_ENTRY_BYTES:
+                        kept = None
+    await response.write(b"]")
+    await response.write_eof()
+    if kept is not None:
+        kept.append(b"]")
+        body = b"".join(kept)
+        store_response(request, version, key, etag, body, {}, frozenset(ids), tag_set)
+    return response
+
+
 # This dictionary, TODOS, represents a collection of todo items.
 # Each todo item is represented as a dictionary with keys for 'title', 'order', and 'completed'.
 
@@ -30,13 +531,10 @@ TODOS = {
 }
 
 
+# With "?tags=a,b" only the todos having any of the tags are returned ("&match=all" for all of them).
 async def get_all_todos(request):
-    pool = await create_pool()  # Await the create_pool coroutine here
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute("SELECT * FROM todos")
-            result = await cur.fetchall()
-            return web.json_response(result)
+    tags, match = parse_tag_query(request)
+    return await list_todos(request, tags, match)
 
 
 # This function, get_all_todos, is a request handler that returns a JSON response
@@ -46,26 +544,39 @@ async def get_all_todos(request):
 #        {'id': key, **todo} for key, todo in TODOS.items()
 #    ])
 
+
 # Define the function to remove all todos
 async def remove_all_todos(request):
 
-    pool = await create_pool()
-
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
+    async with acquire(request.app) as conn:
+        async with conn.cursor() as cur, transaction(conn):
+            await cur.execute("DELETE FROM todo_tags")
             await cur.execute("DELETE FROM todos")
+        record_write(request.app)
+        publish_change(request.app, {"op": "clear"})
         return web.Response(status=204)
 
 
 # Define the function to get a single todo by ID
 async def get_one_todo(request):
     id = int(request.match_info["id"])
+    key = ("todo", id)
 
-    # Connect to the database
-    pool = await create_pool()
+    # Answer from the known todo version or the response cache when possible
+    known_version = None
+    if request.app["process_cache"]:
+        known_version = request.app["todo_versions"].get(id)
+    if known_version is not None and etag_matches(request, todo_etag(known_version)):
+        return not_modified(request, todo_etag(known_version))
+    entry = request.app["cache"].get(key)
+    if entry is not None:
+        if etag_matches(request, entry.etag):
+            return not_modified(request, entry.etag)
+        return cached_response(entry)
+    version = request.app["collection_version"]
 
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
+    async with acquire(request.app) as conn:
+        async with conn.cursor(TimedDictCursor) as cur:
             # Fetch the todo from the database based on its ID
             await cur.execute("SELECT * FROM todos WHERE id = %s", (id,))
             todo = await cur.fetchone()
@@ -74,8 +585,223 @@ async def get_one_todo(request):
             if not todo:
                 return web.json_response({"error": "Todo not found"}, status=404)
 
-            # Return the retrieved todo as JSON response
-            return web.json_response(todo)
+    etag = todo_etag(todo["version"])
+    if request.app["process_cache"] and request.app["collection_version"] == version:
+        request.app["todo_versions"].set(id, todo["version"])
+    if etag_matches(request, etag):
+        return not_modified(request, etag)
+
+    # Return the retrieved todo as JSON response
+    body = json.dumps(todo).encode()
+    store_response(request, version, key, etag, body, {}, frozenset([id]), frozenset())
+    return web.Response(
+        body=body, content_type="application/json", headers={"ETag": etag}
+    )
+
+
+def todo_url(request, id):
+    return str(request.url.join(request.app.router["one_todo"].url_for(id=str(id))))
+
+
+# Insert validated new todos with one multi-row INSERT and return their ids. The ids
+# of the rows of a single INSERT are consecutive, starting at lastrowid (this needs
+# auto_increment_increment = 1, the MySQL default).
+async def insert_todos(cur, todos):
+    rows = [
+        (
+            data["title"],
+            data.get("order", 1),
+            data.get("completed", False),
+            ",".join(data.get("tags", [])),
+        )
+        for data in todos
+    ]
+    insert_query = (
+        "INSERT INTO todos (title, `order`, completed, tags) VALUES "
+        + ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+    )
+    await cur.execute(insert_query, [value for row in rows for value in row])
+    ids = [cur.lastrowid + i for i in range(len(rows))]
+
+    tag_rows = [
+        (id, tag)
+        for id, data in zip(ids, todos)
+        for tag in dict.fromkeys(data.get("tags", []))
+    ]
+    if tag_rows:
+        await cur.executemany(
+            "INSERT INTO todo_tags (todo_id, tag) VALUES (%s, %s)", tag_rows
+        )
+    return ids
+
+
+# Apply a validated patch to a todo with a single UPDATE of the patched fields, only
+# if its version is one of `versions` when given. Returns the new version, or None
+# when no row matched. LAST_INSERT_ID(expr) hands the new version back through
+# lastrowid, so it does not have to be read again.
+async def patch_row(cur, id, data, versions=None):
+    fields = {key: data[key] for key in PATCH_FIELDS if key in data}
+    values = [
+        ",".join(value) if key == "tags" else value for key, value in fields.items()
+    ]
+    assignments = [f"`{key}` = %s" for key in fields]
+    assignments.append("version = LAST_INSERT_ID(version + 1)")
+    query = f"UPDATE todos SET {', '.join(assignments)} WHERE id = %s"
+    values.append(id)
+    if versions is not None:
+        query += f" AND version IN ({', '.join(['%s'] * len(versions))})"
+        values.extend(versions)
+    await cur.execute(query, values)
+    if not cur.rowcount:
+        return None
+    # lastrowid holds the new version for this statement only: read it before the tag
+    # statements, which reset it to 0 (a patch with tags would return version 0, an
+    # ETag that never matches in If-Match)
+    version = cur.lastrowid
+    if "tags" in fields:
+        await replace_tags(cur, id, fields["tags"])
+    return version
+
+
+async def todo_exists(cur, id):
+    await cur.execute("SELECT 1 FROM todos WHERE id = %s", (id,))
+    return await cur.fetchone() is not None
+
+
+def precondition_failed():
+    return web.json_response(
+        {"error": "Todo was modified, If-Match does not match its version"},
+        status=412,
+    )
+
+
+# Delete todos and their tags, returns the ids that existed.
+async def delete_rows(cur, ids):
+    placeholders = ", ".join(["%s"] * len(ids))
+    await cur.execute(
+        f"SELECT id FROM todos WHERE id IN ({placeholders}) FOR UPDATE", ids
+    )
+    found = [row[0] for row in await cur.fetchall()]
+    if found:
+        placeholders = ", ".join(["%s"] * len(found))
+        await cur.execute(
+            f"DELETE FROM todo_tags WHERE todo_id IN ({placeholders})", found
+        )
+        await cur.execute(f"DELETE FROM todos WHERE id IN ({placeholders})", found)
+    return set(found)
+
+
+# Opt-in batching of creates (TODOS_INSERT_BATCH=1): the todos created within
+# TODOS_INSERT_BATCH_WINDOW_MS milliseconds, or until TODOS_INSERT_BATCH_MAX_ROWS are
+# waiting, are inserted with one multi-row INSERT in one transaction instead of one
+# INSERT and commit per request.
+INSERT_BATCH = os.environ.get("TODOS_INSERT_BATCH", "0") == "1"
+INSERT_BATCH_WINDOW_MS = float(os.environ.get("TODOS_INSERT_BATCH_WINDOW_MS", "2"))
+INSERT_BATCH_MAX_ROWS = int(os.environ.get("TODOS_INSERT_BATCH_MAX_ROWS", "100"))
+
+
+# Collects the todos passed to insert() and hands them to `flush_rows`, a coroutine
+# function taking a list of todos and returning their ids, in batches. Every caller
+# gets the id of its own todo back, or the exception of the failed batch.
+class InsertBatcher:
+    def __init__(self, flush_rows, window_ms, max_rows):
+        self.flush_rows = flush_rows
+        self.window_ms = window_ms
+        self.max_rows = max_rows
+        self.pending = []
+        self.timer = None
+        self.flushing = set()
+        self.batches = 0
+        self.rows = 0
+        self.max_batch_size = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    async def insert(self, data):
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((data, future))
+        if len(self.pending) >= self.max_rows:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(
+                self.window_ms / 1000, self.flush
+            )
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            task = asyncio.ensure_future(self.run(self.pending))
+            self.flushing.add(task)
+            task.add_done_callback(self.flushing.discard)
+            self.pending = []
+
+    async def run(self, batch):
+        start = time.monotonic()
+        try:
+            ids = await self.flush_rows([data for data, _ in batch])
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    # aiohttp answers with the HTTP exception itself, so every
+                    # request needs its own
+                    if isinstance(exc, web.HTTPException):
+                        error = type(exc)(text=exc.text, content_type=exc.content_type)
+                    else:
+                        error = exc
+                    future.set_exception(error)
+            return
+        for (_, future), id in zip(batch, ids):
+            if not future.done():
+                future.set_result(id)
+
+        elapsed = time.monotonic() - start
+        self.batches += 1
+        self.rows += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.flush_seconds += elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    # Insert what is still waiting and wait for the running batches.
+    async def close(self):
+        self.flush()
+        if self.flushing:
+            await asyncio.wait(list(self.flushing))
+
+    def stats(self):
+        return {
+            "window_ms": self.window_ms,
+            "max_rows": self.max_rows,
+            "batches": self.batches,
+            "rows": self.rows,
+            "pending": len(self.pending),
+            "mean_batch_size": self.rows / self.batches if self.batches else 0,
+            "max_batch_size": self.max_batch_size,
+            "mean_flush_ms": (
+                1000 * self.flush_seconds / self.batches if self.batches else 0
+            ),
+            "max_flush_ms": 1000 * self.max_flush_seconds,
+        }
+
+
+async def init_batcher(app):
+    async def flush_rows(todos):
+        async with acquire(app) as conn:
+            async with conn.cursor() as cur, transaction(conn):
+                return await insert_todos(cur, todos)
+
+    app["batcher"] = None
+    if INSERT_BATCH:
+        app["batcher"] = InsertBatcher(
+            flush_rows, INSERT_BATCH_WINDOW_MS, INSERT_BATCH_MAX_ROWS
+        )
+
+
+async def close_batcher(app):
+    if app["batcher"] is not None:
+        await app["batcher"].close()
 
 
 # This asynchronous function, create_todo, is used to create a new todo item
@@ -88,101 +814,184 @@ async def create_todo(request):
             {"error": "Invalid JSON format in request body"}, status=400
         )
 
-    if "title" not in data:
-        return web.json_response({"error": '"title" is a required field'}, status=400)
-    title = data["title"]
-    if not isinstance(title, str) or not len(title):
+    error = validate_todo(data)
+    if error:
+        return web.json_response({"error": error}, status=400)
+
+    if request.app["batcher"] is not None:
+        # Wait for the todo to be inserted together with the other recent creates
+        new_id = await request.app["batcher"].insert(data)
+    else:
+        async with acquire(request.app) as conn:
+            async with conn.cursor() as cur, transaction(conn):
+                # Insert the new todo and its tags into the database
+                [new_id] = await insert_todos(cur, [data])
+    record_write(request.app, new_id, data.get("tags", []), 1)
+    publish_change(request.app, created_event(new_id, data))
+
+    # Return a successful response with HTTP status code 303 (See Other)
+    return web.Response(headers={"Location": todo_url(request, new_id)}, status=303)
+
+
+def not_found(id):
+    return {"status": 404, "id": id, "error": "Todo not found"}
+
+
+# Create, patch and delete many todos in one request and one transaction. The body
+# is a list of operations:
+#   {"op": "create", "data": {...}}, {"op": "patch", "id": 1, "data": {...}}, {"op": "delete", "id": 1}
+# They are applied in order, consecutive creates with one multi-row INSERT and
+# consecutive deletes with one DELETE. The response lists the result of each one.
+async def bulk_todos(request):
+    try:
+        items = await request.json()
+    except ValueError:
         return web.json_response(
-            {"error": '"title" must be a string with at least one character'},
-            status=400,
+            {"error": "Invalid JSON format in request body"}, status=400
         )
-
-    # Ensure the 'tags' field is a list of strings
-    tags = data.get("tags", [])
-    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+    if not isinstance(items, list):
         return web.json_response(
-            {"error": '"tags" must be a list of strings'}, status=400
+            {"error": "the body must be a list of operations"}, status=400
         )
 
-    # Connect to the database
-    pool = await create_pool()
+    # Validate everything first, only valid operations go to the database
+    results = [None] * len(items)
+    operations = []
+    for index, item in enumerate(items):
+        op = item.get("op") if isinstance(item, dict) else None
+        id = item.get("id") if isinstance(item, dict) else None
+        data = item.get("data") if isinstance(item, dict) else None
+        if op not in ("create", "patch", "delete"):
+            error = '"op" must be "create", "patch" or "delete"'
+            results[index] = {"status": 400, "error": error}
+            continue
+        if op != "create" and (not isinstance(id, int) or isinstance(id, bool)):
+            results[index] = not_found(id)
+            continue
+        if op == "create":
+            error = validate_todo(data)
+        elif op == "patch":
+            error = validate_patch(data)
+        else:
+            error = None
+        if error:
+            results[index] = {"status": 400, "id": id, "error": error}
+            continue
+        operations.append((index, op, id, data))
 
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            # Insert the new todo into the database
-            insert_query = "INSERT INTO todos (title,`order`, completed, tags) VALUES (%s, %s, %s, %s)"
-            values = (
-                title,
-                data.get("order", 1),
-                data.get("completed", False),
-                ",".join(tags),
-            )
-            await cur.execute(insert_query, values)
-            await conn.commit()
-
-            # Retrieve the ID of the newly inserted todo
-            new_id = cur.lastrowid
+    writes = []
+    events = []
+    if operations:
+        async with acquire(request.app) as conn:
+            async with conn.cursor() as cur, transaction(conn):
+                for op, group in itertools.groupby(operations, key=lambda o: o[1]):
+                    group = list(group)
+                    if op == "create":
+                        ids = await insert_todos(cur, [data for _, _, _, data in group])
+                        for (index, _, _, data), new_id in zip(group, ids):
+                            url = todo_url(request, new_id)
+                            results[index] = {"status": 201, "id": new_id, "url": url}
+                            writes.append((new_id, data.get("tags", []), 1))
+                            events.append(created_event(new_id, data))
+                    elif op == "patch":
+                        for index, _, id, data in group:
+                            version = await patch_row(cur, id, data)
+                            if version is not None:
+                                url = todo_url(request, id)
+                                results[index] = {"status": 200, "id": id, "url": url}
+                                writes.append((id, data.get("tags", []), version))
+                                events.append(updated_event(id, data, version))
+                            else:
+                                results[index] = not_found(id)
+                    else:
+                        found = await delete_rows(cur, [id for _, _, id, _ in group])
+                        for index, _, id, _ in group:
+                            # An id listed twice is deleted once: the later ones get
+                            # 404, as when they are deleted one at a time
+                            if id in found:
+                                found.discard(id)
+                                results[index] = {"status": 204, "id": id}
+                                writes.append((id, [], None))
+                                events.append({"op": "delete", "id": id})
+                            else:
+                                results[index] = not_found(id)
+    for id, tags, version in writes:
+        record_write(request.app, id, tags, version)
+    for event in events:
+        publish_change(request.app, event)
 
-    # Construct the URL for the new todo
-    url = str(request.url.join(request.app.router["one_todo"].url_for(id=str(new_id))))
-
-    # Return a successful response with HTTP status code 303 (See Other)
-    return web.Response(headers={"Location": url}, status=303)
+    return web.json_response(results)
 
 
-# Define the function to update a todo
+# Define the function to update a todo. Only the fields sent are changed, with one
+# UPDATE (plus the tag rows when "tags" is sent). With an If-Match header the update
+# only happens if the todo is still at that version, otherwise the answer is 412.
 async def update_todo(request):
     id = int(request.match_info["id"])
 
-    # Connect to the database
-    pool = await create_pool()
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.json_response(
+            {"error": "Invalid JSON format in request body"}, status=400
+        )
+    error = validate_patch(data)
+    if error:
+        return web.json_response({"error": error}, status=400)
+    versions = parse_if_match(request)
+    if versions == []:
+        return precondition_failed()
 
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # Check if the todo with the given ID exists in the database
-            await cur.execute("SELECT * FROM todos WHERE id = %s", (id,))
-            todo = await cur.fetchone()
+    async with acquire(request.app) as conn:
+        async with conn.cursor() as cur:
+            if "tags" in data:
+                async with transaction(conn):
+                    version = await patch_row(cur, id, data, versions)
+            else:
+                version = await patch_row(cur, id, data, versions)
 
-            # If the todo doesn't exist, return a 404 error
-            if not todo:
+            # Nothing matched: the todo is missing or at another version
+            if version is None:
+                if versions is not None and await todo_exists(cur, id):
+                    return precondition_failed()
                 return web.json_response({"error": "Todo not found"}, status=404)
+    record_write(request.app, id, data.get("tags", []), version)
+    event = updated_event(id, data, version)
+    publish_change(request.app, event)
 
-            # Update the todo with the data from the request
-            data = await request.json()
-            update_query = "UPDATE todos SET title = %s, `order` = %s, completed = %s, tags = %s WHERE id = %s"
-            await cur.execute(
-                update_query,
-                (data["title"], data["order"], data["completed"], data["tags"], id),
-            )
-            await conn.commit()
-
-            # Fetch the updated todo
-            await cur.execute("SELECT * FROM todos WHERE id = %s", (id,))
-            updated_todo = await cur.fetchone()
-
-    # Return the updated todo as a JSON response
-    return web.json_response(updated_todo)
+    # Return the written fields with the new version, without reading the todo again
+    return web.json_response(
+        {"id": id, **event["fields"], "version": version},
+        headers={"ETag": todo_etag(version)},
+    )
 
 
-# remove todo
+# remove todo. The todo and its tag rows are deleted by one statement, whose row count
+# tells whether the todo existed. If-Match is handled as in update_todo.
 async def remove_todo(request):
     id = int(request.match_info["id"])
+    versions = parse_if_match(request)
+    if versions == []:
+        return precondition_failed()
 
-    # Connect to the database
-    pool = await create_pool()
+    query = (
+        "DELETE t, tt FROM todos t LEFT JOIN todo_tags tt ON tt.todo_id = t.id"
+        " WHERE t.id = %s"
+    )
+    params = [id]
+    if versions is not None:
+        query += f" AND t.version IN ({', '.join(['%s'] * len(versions))})"
+        params.extend(versions)
 
-    async with pool.acquire() as conn:
+    async with acquire(request.app) as conn:
         async with conn.cursor() as cur:
-            # Check if the todo exists
-            await cur.execute("SELECT id FROM todos WHERE id = %s", (id,))
-            existing_todo = await cur.fetchone()
-
-            if not existing_todo:
+            await cur.execute(query, params)
+            if not cur.rowcount:
+                if versions is not None and await todo_exists(cur, id):
+                    return precondition_failed()
                 return web.json_response({"error": "Todo not found"}, status=404)
-
-            # Delete the todo from the database
-            await cur.execute("DELETE FROM todos WHERE id = %s", (id,))
-            await conn.commit()
+    record_write(request.app, id)
+    publish_change(request.app, {"op": "delete", "id": id})
 
     # Return a successful response with HTTP status code 204 (No Content)
     return web.Response(status=204)
@@ -192,46 +1001,117 @@ async def remove_todo(request):
 async def get_todos_by_tag(request):
     tag = request.match_info["tag"]
 
-    # Connect to the database
-    pool = await create_pool()
+    # Return the todos with the specified tag, served from the todo_tags index
+    return await list_todos(request, [tag])
+
+
+# Report how the connection pool is used so it can be sized: connections in use,
+# idle connections and requests waiting for a connection.
+async def get_pool_stats(request):
+    pool = request.app["pool"]
+    return web.json_response(
+        {
+            "minsize": pool.minsize,
+            "maxsize": pool.maxsize,
+            "size": pool.size,
+            "in_use": pool.size - pool.freesize,
+            "free": pool.freesize,
+            "waiters": request.app["pool_waiters"],
+        }
+    )
+
+
+# Report how the response cache is used: entries, bytes, hits, misses and the number
+# of requests answered with 304 Not Modified.
+async def get_cache_stats(request):
+    cache = request.app["cache"]
+    return web.json_response(
+        {
+            "entries": len(cache.entries),
+            "bytes": cache.size,
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "known_versions": len(request.app["todo_versions"].entries),
+            "not_modified": request.app["not_modified"],
+        }
+    )
 
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # Query the database to retrieve todos with the specified tag
-            await cur.execute("SELECT * FROM todos WHERE FIND_IN_SET(%s, tags)", (tag,))
-            todos_with_tag = await cur.fetchall()
 
-    # Return a JSON response with the list of todos with the specified tag
-    return web.json_response(todos_with_tag)
+# Report how creates are batched: number of batches and rows, batch sizes and the
+# time taken to insert a batch.
+async def get_batch_stats(request):
+    batcher = request.app["batcher"]
+    if batcher is None:
+        return web.json_response({"enabled": False})
+    return web.json_response({"enabled": True, **batcher.stats()})
+
+
+# End the change feed streams when the server stops, instead of waiting for them.
+async def close_changes(app):
+    if app["changes"] is not None:
+        app["changes"].close()
 
 
 # These lines configure CORS (Cross-Origin Resource Sharing) settings for the aiohttp
 # application. It sets up CORS to allow cross-origin requests for various routes defined in the application.
+# create_app builds a new application, each one opens its own connection pool when it
+# starts. runner.py uses it to serve the backend from several processes.
+def create_app(process_cache=True):
+    app = web.Application(
+        middlewares=[todo_metrics.request_metrics, todo_metrics.profile_requests]
+    )
+    app["process_cache"] = process_cache
+    app["changes"] = todo_changes.ChangeFeed() if process_cache else None
+    app.on_startup.append(init_pool)
+    app.on_startup.append(init_cache)
+    app.on_startup.append(init_batcher)
+    app.on_shutdown.append(close_changes)
+    app.on_cleanup.append(close_batcher)
+    app.on_cleanup.append(close_pool)
+
+    # Configure default CORS settings.
+    cors = aiohttp_cors.setup(
+        app,
+        defaults={
+            "*": aiohttp_cors.ResourceOptions(
+                allow_credentials=True,
+                expose_headers="*",
+                allow_headers="*",
+                allow_methods="*",
+            )
+        },
+    )
 
-app = web.Application()
-
-# Configure default CORS settings.
-cors = aiohttp_cors.setup(
-    app,
-    defaults={
-        "*": aiohttp_cors.ResourceOptions(
-            allow_credentials=True,
-            expose_headers="*",
-            allow_headers="*",
-            allow_methods="*",
+    cors.add(app.router.add_get("/todos/", get_all_todos, name="all_todos"))
+    cors.add(app.router.add_delete("/todos/", remove_all_todos, name="remove_todos"))
+    cors.add(app.router.add_post("/todos/", create_todo, name="create_todo"))
+    cors.add(app.router.add_post("/todos/_bulk", bulk_todos, name="bulk_todos"))
+    cors.add(app.router.add_get("/todos/{id:\d+}", get_one_todo, name="one_todo"))
+    cors.add(app.router.add_patch("/todos/{id:\d+}", update_todo, name="update_todo"))
+    cors.add(app.router.add_delete("/todos/{id:\d+}", remove_todo, name="remove_todo"))
+    # Create, update and delete events, see todo_changes.py
+    cors.add(
+        app.router.add_get(
+            "/todos/_changes", todo_changes.get_changes, name="todo_changes"
         )
-    },
-)
+    )
+    # route to retrive todo by tag. for exemple /todos/tag/work
+    cors.add(
+        app.router.add_get("/todos/tag/{tag}", get_todos_by_tag, name="todos_by_tag")
+    )
+    cors.add(app.router.add_get("/pool/stats", get_pool_stats, name="pool_stats"))
+    cors.add(app.router.add_get("/cache/stats", get_cache_stats, name="cache_stats"))
+    cors.add(app.router.add_get("/batch/stats", get_batch_stats, name="batch_stats"))
+    app.router.add_get("/metrics", todo_metrics.get_metrics, name="metrics")
+    return app
 
-cors.add(app.router.add_get("/todos/", get_all_todos, name="all_todos"))
-cors.add(app.router.add_delete("/todos/", remove_all_todos, name="remove_todos"))
-cors.add(app.router.add_post("/todos/", create_todo, name="create_todo"))
-cors.add(app.router.add_get("/todos/{id:\d+}", get_one_todo, name="one_todo"))
-cors.add(app.router.add_patch("/todos/{id:\d+}", update_todo, name="update_todo"))
-cors.add(app.router.add_delete("/todos/{id:\d+}", remove_todo, name="remove_todo"))
-# route to retrive todo by tag. for exemple /todos/tag/work
-cors.add(app.router.add_get("/todos/tag/{tag}", get_todos_by_tag, name="todos_by_tag"))
-# This code sets up basic logging and runs the aiohttp web application on port 8081.
-
-logging.basicConfig(level=logging.DEBUG)
-web.run_app(app, port=8083)
+
+# This code sets up basic logging and runs the aiohttp web application on port 8083.
+# The log level is TODOS_LOG_LEVEL (default INFO), and the access log is sampled.
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("TODOS_LOG_LEVEL", "INFO"))
+    web.run_app(
+        create_app(),
+        port=8083,
+        access_log_class=todo_metrics.SampledAccessLogger,
+    )
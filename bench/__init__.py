@@ -0,0 +1 @@
+# Benchmarks for the todo backends. Run the modules with "python -m bench.<name>".
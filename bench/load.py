@@ -0,0 +1,388 @@
+# Load test of either backend: start a server, fill it with a dataset, send a mix of
+# requests from concurrent connections and report the throughput and latency
+# percentiles of every route.
+#
+#   python -m bench.load --backend memory --dataset 1000 10000 100000 --output memory.json
+#   python -m bench.load --backend mysql --dataset 10000 --baseline memory.json
+#
+# The memory backend is started with runner.py. The MySQL backend runs on the SQLite
+# stand-in of bench/sqlite_mysql.py by default, or with --database server on the MySQL
+# server configured by the TODOS_DB_* variables (its tables are emptied first). --url
+# targets a server that is already running instead.
+#
+# --mix gives the share of each operation: list (GET /todos/), one (GET /todos/{id}),
+# tag (GET /todos/tag/{tag}), create, patch and delete. Lists are paginated with
+# --page-size, 0 asks for the whole list. Each --dataset size is run on a fresh server
+# filled through POST /todos/_bulk. --record writes the operations sent to a JSON lines
+# file, which --replay sends again (in order, with the same concurrency).
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from bench.workers import ROOT, free_port, wait_for_server
+
+OPERATIONS = ('list', 'one', 'tag', 'create', 'patch', 'delete')
+# The route names of the servers, used as the keys of the results
+ROUTES = {
+    'list': 'all_todos',
+    'one': 'one_todo',
+    'tag': 'todos_by_tag',
+    'create': 'create_todo',
+    'patch': 'update_todo',
+    'delete': 'remove_todo',
+}
+DEFAULT_MIX = 'list=15,one=45,tag=15,create=10,patch=10,delete=5'
+SEED_BATCH = 1000
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS or not weight.replace('.', '', 1).isdigit():
+            raise argparse.ArgumentTypeError(f'invalid mix entry {part!r}, expected <operation>=<weight>')
+        mix[name] = float(weight)
+    if not sum(mix.values()):
+        raise argparse.ArgumentTypeError('the mix needs at least one positive weight')
+    return mix
+
+
+# Start the server under test. Returns the process (None with --url) and the base url.
+def start_server(args, workdir):
+    if args.url:
+        return None, args.url.rstrip('/')
+    port = free_port()
+    if args.backend == 'mysql' and args.database == 'sqlite':
+        command = ['-m', 'bench.sqlite_mysql', '--database', os.path.join(workdir, 'todos.sqlite3')]
+    else:
+        command = ['runner.py', '--backend', args.backend, '--workers', str(args.workers)]
+    server = subprocess.Popen(
+        [sys.executable, *command, '--host', '127.0.0.1', '--port', str(port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    wait_for_server(port)
+    return server, f'http://127.0.0.1:{port}'
+
+
+def stop_server(server):
+    if server is not None:
+        server.terminate()
+        server.wait(timeout=60)
+
+
+class Workload:
+    def __init__(self, session, base_url, args, rng):
+        self.session = session
+        self.base_url = base_url
+        self.args = args
+        self.rng = rng
+        self.tags = [f'tag{i}' for i in range(args.tags)]
+        # Ids of the todos created so far, in order. Operations refer to todos by their
+        # position in this list, so that a replay works whatever ids the server gives.
+        self.ids = []
+        self.latencies = {route: [] for route in ROUTES.values()}
+        self.statuses = {route: {} for route in ROUTES.values()}
+        self.errors = {route: 0 for route in ROUTES.values()}
+        self.recording = None
+        self.measuring = False
+
+    def random_todo(self):
+        tags = self.rng.sample(self.tags, min(len(self.tags), self.rng.randint(1, 2)))
+        return {'title': f'todo {self.rng.getrandbits(32):08x}', 'order': self.rng.randrange(1000),
+                'completed': False, 'tags': tags}
+
+    # Fill the server with `count` todos, several bulk requests at a time.
+    async def seed(self, count):
+        async with self.session.delete(self.base_url + '/todos/') as response:
+            response.raise_for_status()
+        self.ids = []
+        batches = [[{'op': 'create', 'data': self.random_todo()} for _ in range(min(SEED_BATCH, count - start))]
+                   for start in range(0, count, SEED_BATCH)]
+        for start in range(0, len(batches), self.args.concurrency):
+            answers = await asyncio.gather(*(self.bulk(batch) for batch in batches[start:start + self.args.concurrency]))
+            for results in answers:
+                self.ids.extend(result['id'] for result in results if result['status'] == 201)
+
+    async def bulk(self, batch):
+        async with self.session.post(self.base_url + '/todos/_bulk', json=batch) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    # Pick the next operation of the mix.
+    def next_operation(self, mix):
+        op = self.rng.choices(list(mix), weights=list(mix.values()))[0]
+        entry = {'op': op}
+        if op in ('one', 'patch', 'delete'):
+            entry['ref'] = self.rng.randrange(len(self.ids)) if self.ids else 0
+        if op == 'tag':
+            entry['tag'] = self.rng.choice(self.tags)
+        if op == 'create':
+            entry['body'] = self.random_todo()
+        if op == 'patch':
+            entry['body'] = {'completed': self.rng.random() < 0.5, 'order': self.rng.randrange(1000)}
+        return entry
+
+    def todo_path(self, ref):
+        id = self.ids[ref % len(self.ids)] if self.ids else 0
+        return f'/todos/{id}'
+
+    # The request of an operation: method, path and JSON body.
+    def request(self, entry):
+        op = entry['op']
+        page = f'?limit={self.args.page_size}' if self.args.page_size else ''
+        if op == 'list':
+            return 'GET', '/todos/' + page, None
+        if op == 'tag':
+            return 'GET', f'/todos/tag/{entry["tag"]}' + page, None
+        if op == 'create':
+            return 'POST', '/todos/', entry['body']
+        if op == 'patch':
+            return 'PATCH', self.todo_path(entry['ref']), entry['body']
+        if op == 'delete':
+            return 'DELETE', self.todo_path(entry['ref']), None
+        return 'GET', self.todo_path(entry['ref']), None
+
+    async def send(self, entry):
+        method, path, body = self.request(entry)
+        route = ROUTES[entry['op']]
+        if self.recording is not None:
+            self.recording.write(json.dumps(entry) + '\n')
+        start = time.perf_counter()
+        try:
+            async with self.session.request(method, self.base_url + path, json=body,
+                                            allow_redirects=False) as response:
+                await response.read()
+                status = response.status
+                location = response.headers.get('Location')
+        except aiohttp.ClientError:
+            status, location = 'error', None
+        elapsed = time.perf_counter() - start
+
+        if location is not None:
+            self.ids.append(int(location.rstrip('/').rsplit('/', 1)[1]))
+        # A deleted todo is not picked again, so later operations keep hitting todos
+        # that exist instead of counting 404s as requests served
+        if entry['op'] == 'delete' and status == 204:
+            self.ids.remove(int(path.rsplit('/', 1)[1]))
+        if not self.measuring:
+            return
+        self.latencies[route].append(elapsed)
+        self.statuses[route][str(status)] = self.statuses[route].get(str(status), 0) + 1
+        if status == 'error' or status >= 500:
+            self.errors[route] += 1
+
+    # Send operations from `concurrency` connections until the deadline or until the
+    # operations run out.
+    async def run(self, operations, deadline=None):
+        iterator = iter(operations)
+
+        async def connection():
+            for entry in iterator:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                await self.send(entry)
+
+        await asyncio.gather(*(connection() for _ in range(self.args.concurrency)))
+
+
+def generated(workload, mix, count=None):
+    sent = 0
+    while count is None or sent < count:
+        yield workload.next_operation(mix)
+        sent += 1
+
+
+def replayed(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest rank
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def summarize(workload, elapsed):
+    routes = {}
+    for route, latencies in workload.latencies.items():
+        if not latencies:
+            continue
+        latencies.sort()
+        routes[route] = {
+            'requests': len(latencies),
+            'errors': workload.errors[route],
+            'statuses': workload.statuses[route],
+            'throughput': len(latencies) / elapsed,
+            'mean_ms': 1000 * sum(latencies) / len(latencies),
+            'p50_ms': 1000 * percentile(latencies, 0.50),
+            'p95_ms': 1000 * percentile(latencies, 0.95),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'max_ms': 1000 * latencies[-1],
+        }
+    requests = sum(route['requests'] for route in routes.values())
+    return {
+        'elapsed_s': elapsed,
+        'requests': requests,
+        'errors': sum(route['errors'] for route in routes.values()),
+        'throughput': requests / elapsed if elapsed else 0,
+        'routes': routes,
+    }
+
+
+async def run_dataset(args, base_url, dataset, recording):
+    rng = random.Random(args.seed)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        workload = Workload(session, base_url, args, rng)
+        await workload.seed(dataset)
+
+        if args.replay:
+            workload.measuring = True
+            start = time.perf_counter()
+            await workload.run(replayed(args.replay))
+            return summarize(workload, time.perf_counter() - start)
+
+        if args.warmup:
+            await workload.run(generated(workload, args.mix), time.perf_counter() + args.warmup)
+        workload.measuring = True
+        workload.recording = recording
+        start = time.perf_counter()
+        if args.requests:
+            await workload.run(generated(workload, args.mix, args.requests))
+        else:
+            await workload.run(generated(workload, args.mix), start + args.duration)
+        return summarize(workload, time.perf_counter() - start)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    for run in results['runs']:
+        print(f'dataset {run["dataset"]}: {run["throughput"]:.0f} requests/s, '
+              f'{run["requests"]} requests, {run["errors"]} errors')
+        print(f'  {"route":<14}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>8}')
+        for route, stats in run['routes'].items():
+            print(f'  {route:<14}{stats["throughput"]:>10.0f}{stats["p50_ms"]:>10.2f}'
+                  f'{stats["p95_ms"]:>10.2f}{stats["p99_ms"]:>10.2f}{stats["errors"]:>8}')
+
+
+# Print the change of throughput and p99 of every route against a saved run, matching
+# the runs by dataset size.
+def print_comparison(results, baseline):
+    previous_runs = {run['dataset']: run for run in baseline['runs']}
+    for run in results['runs']:
+        previous = previous_runs.get(run['dataset'])
+        if previous is None:
+            print(f'dataset {run["dataset"]}: not in the baseline')
+            continue
+        print(f'dataset {run["dataset"]} against the baseline ({baseline["config"]["backend"]}, '
+              f'commit {baseline.get("commit")}):')
+        print(f'  {"route":<14}{"req/s":>18}{"p99 ms":>20}')
+        for route, stats in run['routes'].items():
+            before = previous['routes'].get(route)
+            if before is None:
+                continue
+            print(f'  {route:<14}{change(before["throughput"], stats["throughput"]):>18}'
+                  f'{change(before["p99_ms"], stats["p99_ms"]):>20}')
+
+
+def change(before, after):
+    if not before:
+        return f'{after:.1f}'
+    return f'{after:.1f} ({100 * (after - before) / before:+.0f}%)'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the todos backends.')
+    parser.add_argument('--backend', choices=('memory', 'mysql'), default='memory')
+    parser.add_argument('--database', choices=('sqlite', 'server'), default='sqlite',
+                        help='MySQL backend: the SQLite stand-in or the configured MySQL server')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes (runner.py)')
+    parser.add_argument('--url', help='test a running server instead of starting one')
+    parser.add_argument('--dataset', type=int, nargs='+', default=[1000], help='todos loaded before each run')
+    parser.add_argument('--tags', type=int, default=20, help='distinct tags in the dataset')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'operation weights (default {DEFAULT_MIX})')
+    parser.add_argument('--page-size', type=int, default=100, help='limit of list requests, 0 for no limit')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent connections')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--requests', type=int, help='send this many requests instead of running for --duration')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of unmeasured requests first')
+    parser.add_argument('--timeout', type=float, default=60, help='request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--record', help='write the operations sent to this file')
+    parser.add_argument('--replay', help='send the operations of a recorded file instead of the mix')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='compare with the results saved by an earlier run')
+    parser.add_argument('--verbose', action='store_true', help='show the server output')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {
+        'config': {
+            'backend': args.backend,
+            'database': args.database if args.backend == 'mysql' else None,
+            'workers': args.workers,
+            'mix': args.mix,
+            'page_size': args.page_size,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'requests': args.requests,
+            'tags': args.tags,
+            'seed': args.seed,
+            'replay': args.replay,
+        },
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'runs': [],
+    }
+    recording = open(args.record, 'w') if args.record else None
+    try:
+        for dataset in args.dataset:
+            # A fresh server (and database) for every dataset size
+            with tempfile.TemporaryDirectory(prefix='todos-bench-') as workdir:
+                server, base_url = start_server(args, workdir)
+                try:
+                    run = asyncio.run(run_dataset(args, base_url, dataset, recording))
+                finally:
+                    stop_server(server)
+            results['runs'].append({'dataset': dataset, **run})
+    finally:
+        if recording is not None:
+            recording.close()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
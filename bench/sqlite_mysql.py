@@ -0,0 +1,256 @@
+# An in-process stand-in for MySQL, to benchmark app_mysql.py without a database
+# server. It provides the part of the aiomysql API app_mysql.py uses (create_pool and
+# the Cursor, DictCursor and SSDictCursor classes) on top of a SQLite file, and
+# rewrites the few MySQL-only statements of app_mysql.py into SQLite ones.
+#
+#   python -m bench.sqlite_mysql --database /tmp/todos.db --port 8083
+#
+# installs this module as aiomysql, then serves app_mysql.create_app(). The numbers it
+# gives measure the Python side of the MySQL backend (handlers, cache, pool, JSON)
+# with SQLite's query costs, not MySQL's. SQLite has a single writer: writes take a
+# lock shared by the pool, reads run concurrently (WAL mode). Queries run on the event
+# loop thread.
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+from aiohttp import web
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS todos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    `order` INTEGER,
+    completed BOOLEAN NOT NULL DEFAULT 0,
+    tags TEXT NOT NULL DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS todo_tags (
+    todo_id INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (tag, todo_id)
+);
+CREATE INDEX IF NOT EXISTS idx_todo_tags_todo_id ON todo_tags (todo_id);
+'''
+
+# The SQLite file used by create_pool, set by main() or the caller.
+DATABASE = os.environ.get('TODOS_SQLITE_PATH', 'todos.sqlite3')
+
+# The multi-table DELETE of remove_todo, run as two statements with the same condition
+MULTI_DELETE = re.compile(
+    r'^DELETE t, tt FROM todos t LEFT JOIN todo_tags tt ON tt\.todo_id = t\.id WHERE (.*)$', re.S)
+
+
+# Return the SQLite statements, with their parameters, running a MySQL statement.
+def translate(query, args):
+    params = list(args or ())
+    query = query.replace('%s', '?')
+    match = MULTI_DELETE.match(query)
+    if match is not None:
+        condition = match.group(1)
+        return [
+            (f'DELETE FROM todo_tags WHERE todo_id IN (SELECT t.id FROM todos t WHERE {condition})', params),
+            (f'DELETE FROM todos AS t WHERE {condition}', params),
+        ]
+    if query.endswith(' FOR UPDATE'):
+        query = query[:-len(' FOR UPDATE')]
+    return [(query, params)]
+
+
+def create_schema(path):
+    db = sqlite3.connect(path)
+    try:
+        db.execute('PRAGMA journal_mode = WAL')
+        db.executescript(SCHEMA)
+    finally:
+        db.close()
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self.lastrowid = None
+        self.result = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.result = None
+
+    def row(self, row):
+        return tuple(row)
+
+    async def execute(self, query, args=None):
+        connection = self.connection
+        if connection.in_transaction or query.lstrip()[:6].upper() == 'SELECT':
+            return self.run(query, args)
+        async with connection.pool.write_lock:
+            return self.run(query, args)
+
+    def run(self, query, args):
+        db = self.connection.db
+        statements = translate(query, args)
+        # A statement rewritten into several must still be atomic
+        atomic = len(statements) > 1 and not self.connection.in_transaction
+        self.connection.last_insert_id = None
+        self.rowcount = 0
+        if atomic:
+            db.execute('BEGIN IMMEDIATE')
+        try:
+            for statement, params in statements:
+                self.result = db.execute(statement, params)
+                if self.result.rowcount > 0:
+                    self.rowcount += self.result.rowcount
+        except BaseException:
+            if atomic:
+                db.execute('ROLLBACK')
+            raise
+        if atomic:
+            db.execute('COMMIT')
+        # As with MySQL, lastrowid is the value given to LAST_INSERT_ID(expr), or the id
+        # of the first row of an INSERT (SQLite reports the last one), or 0.
+        if self.connection.last_insert_id is not None:
+            self.lastrowid = self.connection.last_insert_id
+        elif query.lstrip()[:6].upper() == 'INSERT':
+            self.lastrowid = self.result.lastrowid - self.rowcount + 1
+        else:
+            self.lastrowid = 0
+        return self.rowcount
+
+    async def executemany(self, query, args):
+        for params in args:
+            await self.execute(query, params)
+
+    async def fetchone(self):
+        row = self.result.fetchone()
+        return None if row is None else self.row(row)
+
+    async def fetchmany(self, size):
+        return [self.row(row) for row in self.result.fetchmany(size)]
+
+    async def fetchall(self):
+        return [self.row(row) for row in self.result.fetchall()]
+
+
+class DictCursor(Cursor):
+    def row(self, row):
+        return dict(row)
+
+
+# SQLite cursors already read their rows lazily
+class SSDictCursor(DictCursor):
+    pass
+
+
+class Connection:
+    def __init__(self, pool, cursorclass):
+        self.pool = pool
+        self.cursorclass = cursorclass
+        self.db = sqlite3.connect(pool.path, isolation_level=None, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.create_function('LAST_INSERT_ID', 1, self.set_last_insert_id)
+        self.last_insert_id = None
+        self.in_transaction = False
+
+    def set_last_insert_id(self, value):
+        self.last_insert_id = value
+        return value
+
+    def cursor(self, *cursors):
+        return (cursors[0] if cursors else self.cursorclass)(self)
+
+    async def begin(self):
+        await self.pool.write_lock.acquire()
+        self.db.execute('BEGIN IMMEDIATE')
+        self.in_transaction = True
+
+    async def commit(self):
+        self.end('COMMIT')
+
+    async def rollback(self):
+        self.end('ROLLBACK')
+
+    def end(self, statement):
+        if self.in_transaction:
+            self.in_transaction = False
+            try:
+                self.db.execute(statement)
+            finally:
+                self.pool.write_lock.release()
+
+
+class Pool:
+    def __init__(self, path, minsize, maxsize, cursorclass):
+        self.path = path
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.cursorclass = cursorclass
+        self.free = []
+        self.size = 0
+        self.released = asyncio.Condition()
+        self.write_lock = asyncio.Lock()
+
+    @property
+    def freesize(self):
+        return len(self.free)
+
+    async def acquire(self):
+        async with self.released:
+            while not self.free and self.size >= self.maxsize:
+                await self.released.wait()
+            if self.free:
+                return self.free.pop()
+            self.size += 1
+        return Connection(self, self.cursorclass)
+
+    def release(self, conn):
+        # A connection given back inside a transaction is rolled back, as aiomysql does
+        conn.end('ROLLBACK')
+        self.free.append(conn)
+        asyncio.ensure_future(self.notify())
+
+    async def notify(self):
+        async with self.released:
+            self.released.notify()
+
+    def close(self):
+        for conn in self.free:
+            conn.db.close()
+        self.free = []
+
+    async def wait_closed(self):
+        pass
+
+
+async def create_pool(minsize=1, maxsize=10, cursorclass=Cursor, **kwargs):
+    return Pool(DATABASE, minsize, maxsize, cursorclass)
+
+
+def main():
+    global DATABASE
+    parser = argparse.ArgumentParser(description='Serve app_mysql.py on a SQLite stand-in for MySQL.')
+    parser.add_argument('--database', default=DATABASE, help='SQLite file, created when missing')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8083)
+    args = parser.parse_args()
+
+    DATABASE = args.database
+    create_schema(DATABASE)
+    # app_mysql.py imports aiomysql: give it this module instead
+    sys.modules['aiomysql'] = sys.modules[__name__]
+    import app_mysql
+    import todo_metrics
+
+    logging.basicConfig(level=os.environ.get('TODOS_LOG_LEVEL', 'INFO'))
+    web.run_app(app_mysql.create_app(), host=args.host, port=args.port, print=None,
+                access_log_class=todo_metrics.SampledAccessLogger)
+
+
+if __name__ == '__main__':
+    main()
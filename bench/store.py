@@ -0,0 +1,84 @@
+# Memory and insert throughput of the in-memory store: TodoStore against the
+# dictionary of dictionaries app.py used before, where every todo was a dict holding
+# its own url and ids were allocated with max(TODOS.keys()) + 1.
+#
+#   python -m bench.store --count 20000
+#
+# Both sides parse the same JSON bodies, as the create handler does. The dict of dicts
+# allocation is quadratic, so keep --count moderate or skip it with --skip-dicts.
+import argparse
+import json
+import time
+import tracemalloc
+
+from todo_store import TodoStore
+
+TAGS = ['work', 'home', 'social', 'miscellaneous', 'errands']
+
+
+def bodies(count):
+    for i in range(count):
+        tags = [TAGS[i % len(TAGS)], TAGS[(i * 7) % len(TAGS)]]
+        yield json.dumps({'title': f'todo number {i}', 'order': i, 'completed': False, 'tags': tags})
+
+
+def fill_dicts(count):
+    todos = {}
+    for body in bodies(count):
+        data = json.loads(body)
+        new_id = max(todos.keys(), default=0) + 1
+        data['url'] = f'http://localhost:8081/todos/{new_id}'
+        data['version'] = 1
+        todos[new_id] = data
+    return todos
+
+
+def fill_store(count):
+    store = TodoStore()
+    for body in bodies(count):
+        store.create(json.loads(body))
+    return store
+
+
+# Returns the bytes still allocated per todo once the store is built, and the inserts
+# per second (timed in a separate run, without tracemalloc slowing it down).
+def measure(fill, count):
+    # Build the bodies outside of the measurement
+    list(bodies(count))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = fill(count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+
+    start = time.perf_counter()
+    fill(count)
+    elapsed = time.perf_counter() - start
+    return {'bytes_per_todo': (after - before) / count, 'inserts_per_second': count / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare TodoStore with a dict of dicts.')
+    parser.add_argument('--count', type=int, default=20000, help='number of todos')
+    parser.add_argument('--skip-dicts', action='store_true', help='only measure TodoStore')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = {'count': args.count, 'todo_store': measure(fill_store, args.count)}
+    if not args.skip_dicts:
+        results['dict_of_dicts'] = measure(fill_dicts, args.count)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.count} todos')
+    for name in ('dict_of_dicts', 'todo_store'):
+        if name in results:
+            result = results[name]
+            print(f'{name:>14}: {result["bytes_per_todo"]:8.1f} bytes/todo '
+                  f'{result["inserts_per_second"]:12.0f} inserts/s')
+
+
+if __name__ == '__main__':
+    main()
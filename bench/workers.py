@@ -0,0 +1,129 @@
+# Requests per second of the in-memory backend served by runner.py with a growing
+# number of worker processes.
+#
+#   python -m bench.workers --workers 1 2 4 --duration 10
+#
+# For every worker count, runner.py is started on a free port, then several client
+# processes (one event loop is not enough to saturate several workers) send a mix of
+# list, detail and, with --write-ratio, create requests over keep-alive connections.
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port)):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'the server did not start on port {port}')
+
+
+async def client_loop(base_url, connections, duration, write_ratio, seed):
+    rng = random.Random(seed)
+    counts = {'requests': 0, 'errors': 0}
+    deadline = time.monotonic() + duration
+
+    async def one_connection(session):
+        while time.monotonic() < deadline:
+            pick = rng.random()
+            try:
+                if pick < write_ratio:
+                    async with session.post(base_url + '/todos/', json={'title': 'bench', 'tags': ['bench']},
+                                            allow_redirects=False) as response:
+                        await response.read()
+                elif pick < write_ratio + (1 - write_ratio) / 2:
+                    async with session.get(base_url + '/todos/?limit=20') as response:
+                        await response.read()
+                else:
+                    async with session.get(f'{base_url}/todos/{rng.randrange(3)}') as response:
+                        await response.read()
+                if response.status >= 400 and response.status != 404:
+                    counts['errors'] += 1
+                counts['requests'] += 1
+            except aiohttp.ClientError:
+                counts['errors'] += 1
+
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(one_connection(session) for _ in range(connections)))
+    return counts
+
+
+def client_process(args):
+    return asyncio.run(client_loop(*args))
+
+
+def run_once(workers, args):
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen(
+        [sys.executable, 'runner.py', '--backend', 'memory', '--workers', str(workers),
+         '--host', '127.0.0.1', '--port', str(port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(port)
+        # Let every worker load its replica before measuring
+        time.sleep(1)
+        jobs = [(base_url, args.connections, args.duration, args.write_ratio, seed)
+                for seed in range(args.clients)]
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.map(client_process, jobs)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    requests = sum(result['requests'] for result in results)
+    return {
+        'workers': workers,
+        'requests': requests,
+        'errors': sum(result['errors'] for result in results),
+        'requests_per_second': requests / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure requests/s of runner.py for several worker counts.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to measure')
+    parser.add_argument('--clients', type=int, default=4, help='client processes')
+    parser.add_argument('--connections', type=int, default=32, help='connections per client process')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--write-ratio', type=float, default=0.0, help='share of create requests')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = [run_once(workers, args) for workers in args.workers]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f'{result["workers"]:>2} worker(s): {result["requests_per_second"]:10.0f} requests/s '
+              f'({result["errors"]} errors)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+-- Move tags out of the comma-joined todos.tags column into an indexed join table,
+-- so tag lookups use the (tag, todo_id) primary key instead of FIND_IN_SET over
+-- every row. todos.tags is kept as the display copy returned in responses; the
+-- application writes both.
+CREATE TABLE IF NOT EXISTS todo_tags (
+    todo_id INT NOT NULL,
+    tag VARCHAR(255) NOT NULL,
+    PRIMARY KEY (tag, todo_id),
+    KEY idx_todo_tags_todo_id (todo_id)
+);
+
+-- Split the existing comma-joined tags into one row per (todo, tag).
+INSERT IGNORE INTO todo_tags (todo_id, tag)
+WITH RECURSIVE split (todo_id, tag, rest) AS (
+    SELECT id,
+           SUBSTRING_INDEX(tags, ',', 1),
+           IF(LOCATE(',', tags) > 0, SUBSTRING(tags, LOCATE(',', tags) + 1), NULL)
+    FROM todos
+    WHERE tags IS NOT NULL AND tags <> ''
+    UNION ALL
+    SELECT todo_id,
+           SUBSTRING_INDEX(rest, ',', 1),
+           IF(LOCATE(',', rest) > 0, SUBSTRING(rest, LOCATE(',', rest) + 1), NULL)
+    FROM split
+    WHERE rest IS NOT NULL
+)
+SELECT todo_id, tag FROM split WHERE tag <> '';
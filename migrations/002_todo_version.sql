@@ -0,0 +1,4 @@
+-- Version counter of every todo, incremented by each update. It is the ETag of the
+-- todo and is checked against If-Match so concurrent editors get a 412 instead of
+-- overwriting each other's changes.
+ALTER TABLE todos ADD COLUMN version INT NOT NULL DEFAULT 1;
@@ -0,0 +1,150 @@
+# Serve the todos API from several processes, to use more than one CPU core.
+#
+#   python runner.py --backend memory --workers 4 --port 8081
+#   python runner.py --backend mysql --workers 4 --port 8083
+#
+# The workers are forked from this process and all listen on the same port
+# (SO_REUSEPORT), the kernel spreads the connections between them. A worker that dies
+# is started again. SIGINT or SIGTERM stops the workers gracefully, then the runner.
+#
+# The in-memory backend keeps its todos in process memory, so with more than one
+# worker an extra owner process holds them and makes every change, listening on a unix
+# socket only. The workers serve reads from replicas of the todos and forward writes to
+# the owner (see todo_replica.py). The MySQL backend shares the database, but the
+# response cache and ETag shortcuts of app_mysql.py only see the writes of their own
+# process, so they are disabled when there is more than one worker.
+import argparse
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from todo_metrics import SampledAccessLogger
+
+# A process that dies sooner than this after starting is restarted after a delay that
+# doubles each time, up to MAX_RESTART_DELAY seconds.
+MIN_UPTIME = 5
+MAX_RESTART_DELAY = 30
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the todos API from several worker processes.')
+    parser.add_argument('--backend', choices=('memory', 'mysql'), default='memory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=None,
+                        help='default 8081 for memory, 8083 for mysql')
+    parser.add_argument('--owner-socket', default=None,
+                        help='unix socket of the in-memory owner process (default: in a temporary directory)')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.port is None:
+        args.port = 8081 if args.backend == 'memory' else 8083
+    return args
+
+
+# The processes started by the runner: name -> function run in the forked child.
+def process_targets(args):
+    def serve(create_app, **kwargs):
+        return lambda: web.run_app(create_app(), print=None, access_log_class=SampledAccessLogger, **kwargs)
+
+    listen = {'host': args.host, 'port': args.port, 'reuse_port': True}
+    if args.backend == 'mysql':
+        import app_mysql
+        worker = serve(lambda: app_mysql.create_app(process_cache=args.workers == 1), **listen)
+        return {f'worker-{i}': worker for i in range(args.workers)}
+
+    import app
+    if args.workers == 1:
+        return {'worker-0': serve(app.create_app, **listen)}
+
+    socket_path = args.owner_socket
+    if socket_path is None:
+        socket_path = os.path.join(tempfile.mkdtemp(prefix='todos-'), 'owner.sock')
+    targets = {'owner': serve(lambda: app.create_app(owner=True), path=socket_path)}
+    worker = serve(lambda: app.create_app(owner_socket=socket_path), **listen)
+    targets.update((f'worker-{i}', worker) for i in range(args.workers))
+    return targets
+
+
+class Runner:
+    def __init__(self, targets):
+        self.targets = targets
+        self.pids = {}
+        self.started = {}
+        self.delays = {name: 0 for name in targets}
+        self.stopping = False
+
+    def spawn(self, name):
+        pid = os.fork()
+        if pid == 0:
+            # The child gets the default handlers back, run_app installs its own
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                self.targets[name]()
+            except BaseException:
+                logging.exception('%s failed', name)
+                code = 1
+            finally:
+                os._exit(code)
+        self.pids[pid] = name
+        self.started[name] = time.monotonic()
+        logging.info('started %s (pid %d)', name, pid)
+
+    # Stop the workers first, and the owner once they are gone, so that the workers do
+    # not see their replication stream end while they are still serving.
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        workers = [pid for pid, name in self.pids.items() if name != 'owner']
+        for pid in workers or list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for name in self.targets:
+            self.spawn(name)
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            name = self.pids.pop(pid, None)
+            if self.stopping:
+                if name != 'owner' and all(name == 'owner' for name in self.pids.values()):
+                    self.stop()
+                continue
+            if name is None:
+                continue
+            logging.warning('%s (pid %d) exited with status %d', name, pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - self.started[name] < MIN_UPTIME:
+                self.delays[name] = min(max(self.delays[name] * 2, 0.5), MAX_RESTART_DELAY)
+            else:
+                self.delays[name] = 0
+            time.sleep(self.delays[name])
+            if not self.stopping:
+                self.spawn(name)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(levelname)s %(message)s')
+    args = parse_args(argv)
+    targets = process_targets(args)
+    logging.info('serving the %s backend on %s:%d with %d worker(s)',
+                 args.backend, args.host, args.port, args.workers)
+    Runner(targets).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# Tests of the batching of creates of the MySQL backend (InsertBatcher in app_mysql.py),
+# driven by a stub flush_rows instead of a database. Run from the repository root with
+# `python -m pytest tests`.
+import asyncio
+
+from aiohttp import web
+
+from app_mysql import InsertBatcher
+
+
+# A flush_rows recording its batches, giving every todo the id 10 * its "n" field.
+class StubRows:
+    def __init__(self, error=None, delay=0):
+        self.batches = []
+        self.error = error
+        self.delay = delay
+
+    async def __call__(self, todos):
+        self.batches.append(todos)
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return [10 * todo['n'] for todo in todos]
+
+
+def test_every_caller_gets_the_id_of_its_own_todo():
+    rows = StubRows()
+
+    async def run():
+        batcher = InsertBatcher(rows, window_ms=5, max_rows=100)
+        return await asyncio.gather(*[batcher.insert({'n': n}) for n in range(5)])
+
+    assert asyncio.run(run()) == [0, 10, 20, 30, 40]
+    assert rows.batches == [[{'n': n} for n in range(5)]]
+
+
+def test_batch_is_flushed_when_the_window_expires():
+    rows = StubRows()
+
+    async def run():
+        batcher = InsertBatcher(rows, window_ms=20, max_rows=100)
+        insert = asyncio.ensure_future(batcher.insert({'n': 1}))
+        await asyncio.sleep(0)
+        # Waiting for more todos until the window expires
+        assert rows.batches == []
+        assert batcher.stats()['pending'] == 1
+        return await asyncio.wait_for(insert, 1)
+
+    assert asyncio.run(run()) == 10
+    assert rows.batches == [[{'n': 1}]]
+
+
+def test_batch_is_flushed_when_max_rows_are_waiting():
+    rows = StubRows()
+
+    async def run():
+        # The window would not expire during the test
+        batcher = InsertBatcher(rows, window_ms=60000, max_rows=3)
+        inserts = [asyncio.ensure_future(batcher.insert({'n': n})) for n in range(4)]
+        ids = await asyncio.wait_for(asyncio.gather(*inserts[:3]), 1)
+        assert not inserts[3].done()
+        assert batcher.stats()['pending'] == 1
+        await batcher.close()
+        return ids + [await inserts[3]]
+
+    assert asyncio.run(run()) == [0, 10, 20, 30]
+    assert rows.batches == [[{'n': 0}, {'n': 1}, {'n': 2}], [{'n': 3}]]
+
+
+def test_every_waiter_gets_its_own_copy_of_a_failed_batch_http_error():
+    error = web.HTTPServiceUnavailable(text='{"error": "no connection"}', content_type='application/json')
+    rows = StubRows(error=error)
+
+    async def run():
+        batcher = InsertBatcher(rows, window_ms=5, max_rows=100)
+        return await asyncio.gather(*[batcher.insert({'n': n}) for n in range(3)], return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert all(isinstance(exc, web.HTTPServiceUnavailable) for exc in errors)
+    # aiohttp answers with the exception itself, so they must not be shared
+    assert len({id(exc) for exc in errors} | {id(error)}) == 4
+    assert all(exc.text == error.text and exc.content_type == 'application/json' for exc in errors)
+
+
+def test_other_errors_are_raised_to_every_waiter():
+    rows = StubRows(error=RuntimeError('lost connection'))
+
+    async def run():
+        batcher = InsertBatcher(rows, window_ms=5, max_rows=100)
+        return await asyncio.gather(*[batcher.insert({'n': n}) for n in range(3)], return_exceptions=True)
+
+    assert [str(exc) for exc in asyncio.run(run())] == ['lost connection'] * 3
+
+
+def test_close_flushes_the_pending_todos():
+    rows = StubRows()
+
+    async def run():
+        batcher = InsertBatcher(rows, window_ms=60000, max_rows=100)
+        insert = asyncio.ensure_future(batcher.insert({'n': 7}))
+        await asyncio.sleep(0)
+        await batcher.close()
+        assert insert.done()
+        assert batcher.stats()['pending'] == 0
+        return insert.result()
+
+    assert asyncio.run(run()) == 70
+    assert rows.batches == [[{'n': 7}]]
+
+
+def test_stats():
+    rows = StubRows(delay=0.01)
+
+    async def run():
+        batcher = InsertBatcher(rows, window_ms=60000, max_rows=3)
+        inserts = [asyncio.ensure_future(batcher.insert({'n': n})) for n in range(4)]
+        await asyncio.gather(*inserts[:3])
+        await batcher.close()
+        await asyncio.gather(*inserts)
+        return batcher.stats()
+
+    stats = asyncio.run(run())
+    assert {key: stats[key] for key in ('window_ms', 'max_rows', 'batches', 'rows', 'pending')} == {
+        'window_ms': 60000, 'max_rows': 3, 'batches': 2, 'rows': 4, 'pending': 0}
+    assert stats['mean_batch_size'] == 2
+    assert stats['max_batch_size'] == 3
+    # Each batch waited 10ms in flush_rows
+    assert 5 <= stats['mean_flush_ms'] <= stats['max_flush_ms']
+
+
+def test_stats_before_any_batch():
+    stats = InsertBatcher(StubRows(), window_ms=2, max_rows=100).stats()
+    assert stats['batches'] == 0
+    assert stats['mean_batch_size'] == 0
+    assert stats['mean_flush_ms'] == 0
+    assert stats['max_flush_ms'] == 0
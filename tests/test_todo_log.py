@@ -0,0 +1,119 @@
+# Tests of the persistence of the in-memory backend (todo_log.py): recovery, group
+# commit and compaction. Run from the repository root with `python -m pytest tests`.
+import asyncio
+import json
+import os
+
+import pytest
+
+from todo_log import LOG_FILE, SNAPSHOT_FILE, CorruptLogError, TodoLog
+
+
+def log_path(directory):
+    return os.path.join(directory, LOG_FILE)
+
+
+def write_log(directory, *lines):
+    with open(log_path(directory), 'wb') as f:
+        f.write(b''.join(lines))
+
+
+def record_line(seq, id):
+    return json.dumps({'seq': seq, 'op': 'delete', 'id': id}).encode() + b'\n'
+
+
+# Append the records in one go, as concurrent requests would, and close the log.
+def append_all(directory, records, snapshot_state=lambda: {}, compact_bytes=1 << 20):
+    async def run():
+        log = TodoLog(directory, snapshot_state, compact_bytes)
+        log.recover()
+        log.start()
+        futures = [log.append(record) for record in records]
+        await asyncio.gather(*futures)
+        await log.close()
+        return log
+    return asyncio.run(run())
+
+
+def test_recover_empty_directory(tmp_path):
+    log = TodoLog(str(tmp_path), dict)
+    assert log.recover() == (None, [])
+    log.log.close()
+
+
+def test_records_survive_a_restart(tmp_path):
+    append_all(str(tmp_path), [{'op': 'delete', 'id': i} for i in range(3)])
+
+    log = TodoLog(str(tmp_path), dict)
+    state, records = log.recover()
+    log.log.close()
+    assert state is None
+    assert records == [{'seq': i + 1, 'op': 'delete', 'id': i} for i in range(3)]
+    assert log.seq == 3
+
+
+def test_group_commit_fsyncs_concurrent_records_together(tmp_path):
+    log = append_all(str(tmp_path), [{'op': 'delete', 'id': i} for i in range(100)])
+    assert log.records == 100
+    assert log.fsyncs < 100
+
+
+def test_torn_last_record_is_dropped(tmp_path):
+    write_log(str(tmp_path), record_line(1, 0), record_line(2, 1), b'{"seq": 3, "op": "del')
+
+    log = TodoLog(str(tmp_path), dict)
+    _, records = log.recover()
+    log.log.close()
+    assert [record['seq'] for record in records] == [1, 2]
+    # The torn bytes are cut off, so the next record starts on a line of its own
+    with open(log_path(str(tmp_path)), 'rb') as f:
+        assert f.read() == record_line(1, 0) + record_line(2, 1)
+
+
+def test_unreadable_last_line_is_dropped(tmp_path):
+    write_log(str(tmp_path), record_line(1, 0), b'{garbage\n')
+
+    log = TodoLog(str(tmp_path), dict)
+    _, records = log.recover()
+    log.log.close()
+    assert [record['seq'] for record in records] == [1]
+
+
+def test_corruption_before_the_last_record_refuses_to_start(tmp_path):
+    write_log(str(tmp_path), record_line(1, 0), b'{garbage\n', record_line(3, 2))
+
+    log = TodoLog(str(tmp_path), dict)
+    with pytest.raises(CorruptLogError, match='record 2 of 3'):
+        log.recover()
+    # Nothing was truncated
+    with open(log_path(str(tmp_path)), 'rb') as f:
+        assert f.read().endswith(record_line(3, 2))
+
+
+def test_compaction_writes_a_snapshot_and_empties_the_log(tmp_path):
+    state = {'count': 0}
+
+    def snapshot_state():
+        return dict(state)
+
+    async def run():
+        log = TodoLog(str(tmp_path), snapshot_state, compact_bytes=200)
+        log.recover()
+        log.start()
+        for i in range(20):
+            state['count'] += 1
+            await log.append({'op': 'delete', 'id': i})
+        await log.close()
+        return log
+
+    log = asyncio.run(run())
+    assert log.compactions > 0
+    assert os.path.exists(os.path.join(str(tmp_path), SNAPSHOT_FILE))
+
+    recovered = TodoLog(str(tmp_path), snapshot_state)
+    snapshot, records = recovered.recover()
+    recovered.log.close()
+    # The snapshot and the records logged after it cover every change, once each
+    assert snapshot['count'] + len(records) == 20
+    assert [record['id'] for record in records] == list(range(snapshot['count'], 20))
+    assert recovered.seq == 20
@@ -0,0 +1,264 @@
+# Change feed shared by both backends: GET /todos/_changes streams the changes made by
+# the write handlers as Server-Sent Events, or as WebSocket messages when the request
+# asks for a WebSocket upgrade.
+#
+# Every change gets a sequence number, one more than the previous change. The event id
+# is "<epoch>-<seq>", the epoch being different for every feed (every server start),
+# so that an id handed out before a restart is never taken for a new one. The last
+# TODOS_CHANGES_BUFFER changes (default 1000) are kept, and a client reconnecting with
+# a Last-Event-ID header (or ?last_event_id= for WebSockets) gets the changes it
+# missed. When they are no longer kept, the client gets a "reset" event instead and
+# must fetch the todos again.
+#
+# Subscribers do not have queues of their own: each one only remembers the last change
+# sent to it and reads the next ones from the buffer, so a burst of changes costs no
+# memory per subscriber. The changes a subscriber has not sent yet stay in the buffer
+# past its size, so a burst larger than the buffer (a big bulk request) does not cut
+# off subscribers that keep up. A subscriber still further behind than the buffer size
+# after TODOS_CHANGES_GRACE seconds (default 5), or behind by more than
+# TODOS_CHANGES_MAX_LAG changes (default 50000), is too slow. It is disconnected
+# (TODOS_CHANGES_SLOW=disconnect, the default), which also frees a connection stuck on
+# a client that stopped reading, or with TODOS_CHANGES_SLOW=drop it misses those
+# changes and gets a "reset" event.
+import asyncio
+import collections
+import itertools
+import json
+import os
+import time
+
+from aiohttp import web
+
+import todo_metrics
+
+BUFFER_SIZE = int(os.environ.get('TODOS_CHANGES_BUFFER', '1000'))
+GRACE = float(os.environ.get('TODOS_CHANGES_GRACE', '5'))
+MAX_LAG = int(os.environ.get('TODOS_CHANGES_MAX_LAG', '50000'))
+SLOW_POLICY = os.environ.get('TODOS_CHANGES_SLOW', 'disconnect')
+# Seconds between keepalive comments (SSE) or pings (WebSocket) on an idle feed
+KEEPALIVE = 15
+
+SUBSCRIBERS = todo_metrics.REGISTRY.gauge(
+    'todos_changes_subscribers', 'Clients following the change feed.')
+SLOW_SUBSCRIBERS = todo_metrics.REGISTRY.counter(
+    'todos_changes_slow_subscribers_total', 'Subscribers that fell behind, by what was done.', ('action',))
+
+
+class Subscriber:
+    def __init__(self, feed, seq, reset):
+        self.feed = feed
+        # Sequence number of the last change sent
+        self.seq = seq
+        # Send a reset event before the next changes
+        self.reset = reset
+        # When the subscriber fell behind by more than the buffer size, or None
+        self.behind_since = None
+        self.woken = asyncio.Event()
+        self.closed = False
+        # The connection, aborted when the subscriber is disconnected for being slow
+        self.transport = None
+
+    # End the stream of this subscriber. With abort, the connection is closed at once,
+    # even when the handler is waiting for the client to read what was already sent.
+    def close(self, abort=False):
+        self.closed = True
+        self.woken.set()
+        if abort and self.transport is not None:
+            self.transport.abort()
+
+    # The items (seq, id, event, data) not sent yet, taken from the buffer.
+    def pending(self):
+        feed = self.feed
+        if self.reset:
+            self.reset = False
+            self.seq = feed.seq
+            return [feed.reset_item()]
+        if self.seq >= feed.seq:
+            return []
+        # The sequence numbers in the buffer follow each other
+        start = len(feed.buffer) - (feed.seq - self.seq)
+        self.seq = feed.seq
+        self.behind_since = None
+        items = list(itertools.islice(feed.buffer, start, None))
+        feed.trim()
+        return items
+
+    # Wait for the next items to send, or None once closed. Raises asyncio.TimeoutError
+    # when nothing happened for `timeout` seconds.
+    async def next(self, timeout):
+        while not self.closed:
+            items = self.pending()
+            if items:
+                return items
+            self.woken.clear()
+            await asyncio.wait_for(self.woken.wait(), timeout)
+        return None
+
+
+class ChangeFeed:
+    def __init__(self, buffer_size=BUFFER_SIZE, policy=SLOW_POLICY, grace=GRACE, max_lag=MAX_LAG):
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        self.buffer = collections.deque()
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.grace = grace
+        self.max_lag = max_lag
+        self.subscribers = set()
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    # Continue the sequence of another feed (a replica continues the owner's feed).
+    def reset(self, seq, epoch):
+        self.seq = seq
+        self.epoch = epoch
+        self.buffer.clear()
+
+    # The sequence number of the oldest change that can still be sent.
+    def oldest(self):
+        return self.buffer[0][0] if self.buffer else self.seq + 1
+
+    # Record a change and wake the subscribers up. `seq` defaults to the next sequence
+    # number, a given one must be the next one too.
+    def publish(self, event, seq=None):
+        self.seq = self.seq + 1 if seq is None else seq
+        data = json.dumps({'seq': self.seq, **event})
+        self.buffer.append((self.seq, self.event_id(self.seq), event['op'], data))
+        now = time.monotonic()
+        for subscriber in list(self.subscribers):
+            lag = self.seq - subscriber.seq
+            if lag > self.buffer_size and not subscriber.reset:
+                if subscriber.behind_since is None:
+                    subscriber.behind_since = now
+                if lag > self.max_lag or now - subscriber.behind_since > self.grace:
+                    self.slow(subscriber)
+            subscriber.woken.set()
+        self.trim()
+
+    def slow(self, subscriber):
+        if self.policy == 'drop':
+            subscriber.reset = True
+            SLOW_SUBSCRIBERS.inc('dropped')
+        else:
+            self.unsubscribe(subscriber)
+            subscriber.close(abort=True)
+            SLOW_SUBSCRIBERS.inc('disconnected')
+
+    # Forget the changes older than the last buffer_size ones that no subscriber still
+    # has to send.
+    def trim(self):
+        keep = self.buffer_size
+        for subscriber in self.subscribers:
+            if not subscriber.reset:
+                keep = max(keep, self.seq - subscriber.seq)
+        while len(self.buffer) > keep:
+            self.buffer.popleft()
+
+    def reset_item(self):
+        data = json.dumps({'seq': self.seq, 'op': 'reset'})
+        return (self.seq, self.event_id(self.seq), 'reset', data)
+
+    # The sequence number of a Last-Event-ID of this feed, or None.
+    def parse_id(self, event_id):
+        epoch, _, seq = event_id.strip().rpartition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    # Register a subscriber, resuming after `last_event_id` when given. An id of another
+    # feed, or older than the buffer, gets a reset event.
+    def subscribe(self, last_event_id=None):
+        seq, reset = self.seq, False
+        if last_event_id is not None:
+            resume = self.parse_id(last_event_id)
+            if resume is not None and self.oldest() - 1 <= resume <= self.seq:
+                seq = resume
+            else:
+                reset = True
+        subscriber = Subscriber(self, seq, reset)
+        self.subscribers.add(subscriber)
+        SUBSCRIBERS.inc()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.discard(subscriber)
+            SUBSCRIBERS.dec()
+            self.trim()
+
+    def close(self):
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+
+async def get_changes(request):
+    feed = request.app['changes']
+    if feed is None:
+        return web.json_response(
+            {'error': 'the change feed is not available when several processes serve the todos'}, status=501)
+    last_event_id = request.headers.get('Last-Event-ID', request.query.get('last_event_id'))
+    subscriber = feed.subscribe(last_event_id)
+    subscriber.transport = request.transport
+    try:
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await stream_websocket(request, subscriber)
+        return await stream_events(request, subscriber)
+    finally:
+        feed.unsubscribe(subscriber)
+
+
+# A client that went away is noticed when writing to it, at the latest with the next
+# keepalive comment.
+async def stream_events(request, subscriber):
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        # Do not let a proxy buffer the events
+        'X-Accel-Buffering': 'no',
+    })
+    await response.prepare(request)
+    try:
+        await response.write(b'retry: 2000\n\n')
+        while True:
+            try:
+                items = await subscriber.next(KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b': keepalive\n\n')
+                continue
+            if items is None:
+                break
+            await response.write(''.join(
+                f'id: {event_id}\nevent: {event}\ndata: {data}\n\n' for _, event_id, event, data in items
+            ).encode())
+    except ConnectionError:
+        # The client went away, or was disconnected for being slow
+        pass
+    return response
+
+
+async def stream_websocket(request, subscriber):
+    ws = web.WebSocketResponse(heartbeat=KEEPALIVE)
+    await ws.prepare(request)
+
+    # Messages from the client are ignored, but must be read to notice it closing
+    async def read():
+        async for _ in ws:
+            pass
+        subscriber.close()
+
+    reader = asyncio.ensure_future(read())
+    try:
+        while True:
+            items = await subscriber.next(None)
+            if items is None:
+                break
+            for _, event_id, _, data in items:
+                # The event data with its id added as the last key
+                await ws.send_str(data[:-1] + f', "id": "{event_id}"}}')
+    except ConnectionError:
+        pass
+    finally:
+        reader.cancel()
+        await ws.close()
+    return ws
@@ -0,0 +1,73 @@
+# Reading and checking the input of requests, shared by both backends so that they
+# accept the same queries and bodies: the tag filter and pagination queries of the
+# lists, and the fields of new todos and patches.
+import json
+
+from aiohttp import web
+
+# Lists are paginated by id: "?limit=20" returns the first 20 todos and a Link header
+# pointing to the next page ("?limit=20&after=<last id>"). Without a limit the whole
+# list is streamed.
+MAX_PAGE_SIZE = 1000
+
+# Only these fields can be changed by a patch, other keys are ignored.
+PATCH_FIELDS = ('title', 'order', 'completed', 'tags')
+
+
+def bad_request(error):
+    return web.HTTPBadRequest(text=json.dumps({'error': error}), content_type='application/json')
+
+
+# Read the "?tags=a,b&match=all" query of a request. Returns (tags, match), tags is None
+# when the request has no tag filter.
+def parse_tag_query(request):
+    if 'tags' not in request.query:
+        return None, 'any'
+    tags = list(dict.fromkeys(tag for tag in request.query['tags'].split(',') if tag))
+    match = request.query.get('match', 'any')
+    if match not in ('any', 'all'):
+        raise bad_request('"match" must be "any" or "all"')
+    return tags, match
+
+
+# Read the "?limit=N&after=ID" query of a list request. Returns (limit, after), limit is
+# None when the whole list is asked for.
+def parse_page(request):
+    limit = request.query.get('limit')
+    after = request.query.get('after', '-1')
+    if not after.lstrip('-').isdigit() or (limit is not None and (not limit.isdigit() or int(limit) < 1)):
+        raise bad_request('"limit" and "after" must be integers, "limit" at least 1')
+    return None if limit is None else min(int(limit), MAX_PAGE_SIZE), int(after)
+
+
+def tags_error(tags):
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return '"tags" must be a list of strings'
+    return None
+
+
+# Check the fields of a new todo. Returns an error message, or None when the todo is valid.
+def validate_todo(data):
+    if not isinstance(data, dict):
+        return 'a todo must be a JSON object'
+    if 'title' not in data:
+        return '"title" is a required field'
+    title = data['title']
+    if not isinstance(title, str) or not len(title):
+        return '"title" must be a string with at least one character'
+    return tags_error(data.get('tags', []))
+
+
+# Check the fields of a patch. Returns an error message, or None when the patch is valid.
+def validate_patch(data):
+    if not isinstance(data, dict):
+        return 'a patch must be a JSON object'
+    if 'title' in data and (not isinstance(data['title'], str) or not len(data['title'])):
+        return '"title" must be a string with at least one character'
+    if 'order' in data and (not isinstance(data['order'], int) or isinstance(data['order'], bool)):
+        return '"order" must be an integer'
+    if 'completed' in data and not isinstance(data['completed'], bool):
+        return '"completed" must be a boolean'
+    if 'tags' in data:
+        return tags_error(data['tags'])
+    return None
@@ -0,0 +1,166 @@
+# Durable storage for the in-memory backend (app.py). Every change to the todos is
+# appended as one JSON line to an append-only log. Records appended while a write is
+# in progress are written and fsynced together (group commit), so a busy server does
+# one fsync for many requests. When the log grows past compact_bytes, the current
+# state is written to a snapshot and the log starts again empty. On startup the state
+# is rebuilt from the snapshot plus the records logged after it.
+import asyncio
+import json
+import logging
+import os
+
+SNAPSHOT_FILE = 'snapshot.json'
+LOG_FILE = 'todos.log'
+
+
+# A record in the middle of the log cannot be read. Replaying the records around it
+# would rebuild a state that never existed, so the server refuses to start instead.
+class CorruptLogError(Exception):
+    pass
+
+
+class TodoLog:
+    # snapshot_state is called to get the JSON-serializable state to compact into a
+    # snapshot, it must include every record appended so far.
+    def __init__(self, directory, snapshot_state, compact_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.snapshot_state = snapshot_state
+        self.compact_bytes = compact_bytes
+        self.seq = 0
+        self.pending = []
+        self.wakeup = None
+        self.writer = None
+        self.closing = False
+        self.log = None
+        self.log_size = 0
+        self.fsyncs = 0
+        self.records = 0
+        self.compactions = 0
+
+    # Read the snapshot and the log. Returns the snapshot state (None without one) and
+    # the records logged after it, in order. Only the last record can have been torn by
+    # a crash, it is dropped; an unreadable record before it raises CorruptLogError.
+    def recover(self):
+        os.makedirs(self.directory, exist_ok=True)
+        state, snapshot_seq = None, 0
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                snapshot = json.load(f)
+            state, snapshot_seq = snapshot['state'], snapshot['seq']
+        self.seq = snapshot_seq
+
+        records, valid_size = [], 0
+        log_path = os.path.join(self.directory, LOG_FILE)
+        if os.path.exists(log_path):
+            with open(log_path, 'rb') as f:
+                lines = f.readlines()
+            for number, line in enumerate(lines, 1):
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('no end of line')
+                    record = json.loads(line)
+                except ValueError as exc:
+                    if number == len(lines):
+                        logging.warning('Dropping the torn last record of %s', log_path)
+                        break
+                    raise CorruptLogError(
+                        f'{log_path}: record {number} of {len(lines)} cannot be read ({exc})') from None
+                valid_size += len(line)
+                # Records up to the snapshot sequence are already in the snapshot
+                if record['seq'] > snapshot_seq:
+                    records.append(record)
+                    self.seq = record['seq']
+
+        self.log = open(log_path, 'ab')
+        self.log.truncate(valid_size)
+        self.log_size = valid_size
+        return state, records
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.writer = asyncio.ensure_future(self.write_loop())
+
+    # Log a record and return a future resolved once it is on disk. The record is
+    # encoded right away, so the caller may change the objects it refers to.
+    def append(self, record):
+        self.seq += 1
+        line = json.dumps({'seq': self.seq, **record}, separators=(',', ':')) + '\n'
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((line.encode(), future))
+        self.wakeup.set()
+        return future
+
+    async def write_loop(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch, self.pending = self.pending, []
+            if batch:
+                await self.commit(batch)
+                if self.log_size >= self.compact_bytes:
+                    await self.compact()
+            if self.closing and not self.pending:
+                return
+
+    async def commit(self, batch):
+        data = b''.join(line for line, _ in batch)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.write, data)
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        self.fsyncs += 1
+        self.records += len(batch)
+
+    def write(self, data):
+        self.log.write(data)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_size += len(data)
+
+    # Write the current state to a new snapshot, then empty the log. The records still
+    # waiting to be written are part of the state, they are written to the emptied log
+    # afterwards but skipped on recovery as their sequence is not above the snapshot's.
+    async def compact(self):
+        snapshot = json.dumps({'seq': self.seq, 'state': self.snapshot_state()})
+        await asyncio.get_event_loop().run_in_executor(None, self.write_snapshot, snapshot)
+        self.compactions += 1
+
+    def write_snapshot(self, snapshot):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.log.truncate(0)
+        self.log.seek(0)
+        os.fsync(self.log.fileno())
+        self.log_size = 0
+
+    # Write what is still waiting and stop the writer.
+    async def close(self):
+        if self.writer is not None:
+            self.closing = True
+            self.wakeup.set()
+            await self.writer
+        self.log.close()
+
+    def stats(self):
+        return {
+            'records': self.records,
+            'fsyncs': self.fsyncs,
+            'log_bytes': self.log_size,
+            'compactions': self.compactions,
+        }
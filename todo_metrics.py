@@ -0,0 +1,255 @@
+# Instrumentation shared by both backends. Metrics are kept in REGISTRY and served by
+# GET /metrics in the Prometheus text format:
+#   - request_metrics, a middleware recording the latency, status and number of
+#     requests in flight of every named route (all_todos, one_todo, ...),
+#   - the query and pool wait times recorded by app_mysql.py.
+# SampledAccessLogger replaces the aiohttp access log, which logged every request, by
+# a sample of them with a cap on lines per second. profile_requests profiles single
+# requests on demand (see PROFILE_TOKEN).
+import asyncio
+import bisect
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import time
+import tracemalloc
+
+from aiohttp import web
+from aiohttp.web_log import AccessLogger
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, self.labelnames, labels, value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (the last one for values above every bound), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket', names, labels + (bound,), cumulative
+            yield self.name + '_sum', self.labelnames, labels, total
+            yield self.name + '_count', self.labelnames, labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    # Return the metric registered under this name, created on first use.
+    def register(self, cls, name, help, labelnames=(), **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labelnames, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labelnames, labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'todos_http_request_duration_seconds', 'Time to answer a request, body included.', ('route', 'method'))
+RESPONSES = REGISTRY.counter(
+    'todos_http_responses_total', 'Responses sent, by status.', ('route', 'method', 'status'))
+IN_FLIGHT = REGISTRY.gauge(
+    'todos_http_requests_in_flight', 'Requests being answered.', ('route',))
+
+
+# Status recorded for the requests whose client disconnected before the end
+CLIENT_CLOSED = 499
+
+
+# Routes are identified by their name, so that /todos/1 and /todos/2 share one series.
+# Requests matching no route (404 and 405 answers) are counted as 'unmatched'.
+def route_name(request):
+    return request.match_info.route.name or 'unmatched'
+
+
+@web.middleware
+async def request_metrics(request, handler):
+    route = route_name(request)
+    IN_FLIGHT.inc(route)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    except (asyncio.CancelledError, ConnectionResetError):
+        # The client went away before the answer was complete (499, as nginx logs it).
+        # aiohttp cancels the handler, or reading the body or writing the answer fails.
+        status = CLIENT_CLOSED
+        raise
+    finally:
+        IN_FLIGHT.dec(route)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route, request.method)
+        RESPONSES.inc(route, request.method, str(status))
+
+
+async def get_metrics(request):
+    return web.Response(
+        body=REGISTRY.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# The access log only writes a TODOS_ACCESS_LOG_SAMPLE fraction of the requests
+# (default 1%), but every server error, and at most TODOS_ACCESS_LOG_RATE lines per
+# second (default 10). The lines left out are counted in
+# todos_access_log_skipped_total.
+ACCESS_LOG_SAMPLE = float(os.environ.get('TODOS_ACCESS_LOG_SAMPLE', '0.01'))
+ACCESS_LOG_RATE = float(os.environ.get('TODOS_ACCESS_LOG_RATE', '10'))
+ACCESS_LOG_SKIPPED = REGISTRY.counter(
+    'todos_access_log_skipped_total', 'Access log lines left out by sampling or rate limiting.', ('reason',))
+
+
+class SampledAccessLogger(AccessLogger):
+    sample = ACCESS_LOG_SAMPLE
+    rate = ACCESS_LOG_RATE
+
+    def __init__(self, logger, log_format=AccessLogger.LOG_FORMAT):
+        super().__init__(logger, log_format)
+        # Token bucket: up to one second of lines can be written at once
+        self.tokens = self.rate
+        self.refilled = time.monotonic()
+
+    def log(self, request, response, time_taken):
+        if response.status < 500 and random.random() >= self.sample:
+            ACCESS_LOG_SKIPPED.inc('sampled')
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1:
+            ACCESS_LOG_SKIPPED.inc('rate_limited')
+            return
+        self.tokens -= 1
+        super().log(request, response, time_taken)
+
+
+# Profiling is enabled by setting TODOS_PROFILE_TOKEN. A request sent with the headers
+# "X-Todos-Profile: cpu" (cProfile) or "X-Todos-Profile: memory" (tracemalloc) and
+# "X-Todos-Profile-Token: <token>" is profiled and the report is written to the
+# todos.profile log. Everything the event loop runs meanwhile, other requests
+# included, is part of the report, and only one request is profiled at a time.
+PROFILE_TOKEN = os.environ.get('TODOS_PROFILE_TOKEN')
+PROFILE_LINES = 25
+profile_logger = logging.getLogger('todos.profile')
+profiling = False
+
+
+def profile_mode(request):
+    mode = request.headers.get('X-Todos-Profile')
+    if mode not in ('cpu', 'memory') or PROFILE_TOKEN is None:
+        return None
+    if request.headers.get('X-Todos-Profile-Token') != PROFILE_TOKEN:
+        return None
+    return mode
+
+
+@web.middleware
+async def profile_requests(request, handler):
+    global profiling
+    mode = profile_mode(request)
+    if mode is None or profiling:
+        return await handler(request)
+
+    profiling = True
+    try:
+        if mode == 'cpu':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return await handler(request)
+            finally:
+                profiler.disable()
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+                profile_logger.info('CPU profile of %s %s\n%s', request.method, request.path_qs, report.getvalue())
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        try:
+            return await handler(request)
+        finally:
+            after = tracemalloc.take_snapshot()
+            if started:
+                tracemalloc.stop()
+            top = after.compare_to(before, 'lineno')[:PROFILE_LINES]
+            profile_logger.info('Memory allocated by %s %s\n%s', request.method, request.path_qs,
+                                '\n'.join(str(stat) for stat in top))
+    finally:
+        profiling = False
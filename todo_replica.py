@@ -0,0 +1,112 @@
+# Worker side of the in-memory backend served by several processes (see runner.py).
+# One owner process holds the todos and makes every change. Each worker keeps a
+# replica: it loads the owner's todos from GET /_replication, then applies the changes
+# the owner streams on the same response. Reads are answered from the replica, writes
+# are forwarded to the owner, and the answer is only returned once the replica has
+# applied the change, so a client always reads its own writes.
+import asyncio
+import json
+import logging
+import os
+import signal
+
+import aiohttp
+from aiohttp import web
+
+# Headers that only concern one connection and are not forwarded to the owner
+HOP_HEADERS = {'connection', 'keep-alive', 'content-length', 'transfer-encoding', 'upgrade'}
+# Headers of the owner's answer returned to the client
+ANSWER_HEADERS = ('Content-Type', 'Location', 'ETag', 'Link')
+
+
+class Replica:
+    # restore(snapshot) replaces the todos with the owner's snapshot (with the 'seq' and
+    # 'epoch' of its change feed), apply(record) applies one change record.
+    def __init__(self, socket_path, restore, apply, connect_timeout=30, sync_timeout=10):
+        self.socket_path = socket_path
+        self.restore = restore
+        self.apply = apply
+        self.connect_timeout = connect_timeout
+        self.sync_timeout = sync_timeout
+        self.seq = 0
+        self.applied = None
+        self.session = None
+        self.stream = None
+        self.follower = None
+        self.stopping = False
+
+    async def start(self, app):
+        self.applied = asyncio.Condition()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=self.socket_path),
+            read_bufsize=16 * 1024 * 1024)
+        # The owner may still be starting
+        deadline = asyncio.get_event_loop().time() + self.connect_timeout
+        while True:
+            try:
+                self.stream = await self.session.get(
+                    'http://owner/_replication', timeout=aiohttp.ClientTimeout(total=None))
+                break
+            except aiohttp.ClientConnectionError:
+                if asyncio.get_event_loop().time() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+        # The snapshot comes first: a header line, then one line per todo
+        header = json.loads(await self.stream.content.readline())
+        todos = [json.loads(await self.stream.content.readline()) for _ in range(header['count'])]
+        self.restore({**header, 'todos': todos})
+        self.seq = header['seq']
+        self.follower = asyncio.ensure_future(self.follow())
+
+    async def follow(self):
+        try:
+            async for line in self.stream.content:
+                record = json.loads(line)
+                self.apply(record)
+                async with self.applied:
+                    self.seq = record['seq']
+                    self.applied.notify_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('Replication stream failed')
+        if self.stopping:
+            return
+        # Without the stream the replica would serve stale todos: stop, the runner
+        # starts a new worker which loads the todos again.
+        logging.error('Lost the replication stream from the owner, stopping the worker')
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    async def wait_for(self, seq):
+        async with self.applied:
+            await asyncio.wait_for(
+                self.applied.wait_for(lambda: self.seq >= seq), self.sync_timeout)
+
+    @web.middleware
+    async def forward_writes(self, request, handler):
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return await handler(request)
+
+        headers = {key: value for key, value in request.headers.items()
+                   if key.lower() not in HOP_HEADERS}
+        async with self.session.request(
+                request.method, 'http://owner' + request.path_qs, data=await request.read(),
+                headers=headers, allow_redirects=False) as answer:
+            body = await answer.read()
+            seq = int(answer.headers.get('X-Todos-Seq', '0'))
+            answer_headers = {key: answer.headers[key] for key in ANSWER_HEADERS if key in answer.headers}
+        await self.wait_for(seq)
+        return web.Response(status=answer.status, body=body, headers=answer_headers)
+
+    # The worker is stopping, the end of the stream is expected.
+    async def stop(self, app):
+        self.stopping = True
+
+    async def close(self, app):
+        if self.follower is not None:
+            self.follower.cancel()
+        if self.stream is not None:
+            self.stream.close()
+        if self.session is not None:
+            await self.session.close()
@@ -0,0 +1,174 @@
+# Storage of the in-memory backend (app.py). Todos are kept as small __slots__ records
+# instead of dictionaries, tags are interned so every todo carrying a tag shares the
+# same string, and ids come from a counter instead of scanning the existing ids. The
+# url of a todo depends on the request and is added when the todo is serialized.
+import bisect
+import heapq
+import itertools
+import json
+import sys
+
+# Only these fields are stored, other keys sent by clients are ignored.
+FIELDS = ('title', 'order', 'completed', 'tags')
+
+
+class Todo:
+    __slots__ = ('title', 'order', 'completed', 'tags', 'version')
+
+    def __init__(self, title, order=None, completed=False, tags=(), version=1):
+        self.title = title
+        self.order = order
+        self.completed = completed
+        self.tags = tuple(sys.intern(tag) for tag in tags)
+        self.version = version
+
+
+class TodoStore:
+    # With json_cache, the encoding of every todo is kept until the todo changes, so
+    # lists are joined from ready-made fragments (TODOS_JSON_CACHE in app.py).
+    def __init__(self, json_cache=True):
+        self.todos = {}
+        # The ids in ascending order, so that a page of a list starts at its cursor
+        # with a binary search instead of walking every smaller id
+        self.id_list = []
+        # Every tag mapped to the ids of the todos carrying it, in ascending order like
+        # id_list, so that a page of a tag-filtered list also starts at its cursor
+        self.tag_index = {}
+        self.next_id = 0
+        self.json_cache = json_cache
+        self.encoded = {}
+        self.cache_stats = {'hits': 0, 'rebuilds': 0}
+
+    def __contains__(self, id):
+        return id in self.todos
+
+    def __len__(self):
+        return len(self.todos)
+
+    def __getitem__(self, id):
+        return self.todos[id]
+
+    # The ids greater than `after` in ascending order, at most `count` of them (all of
+    # them with None). The result is a new list, safe to keep across an await.
+    def ids_after(self, after, count=None):
+        start = bisect.bisect_right(self.id_list, after)
+        return self.id_list[start:None if count is None else start + count]
+
+    def create(self, fields):
+        id = self.next_id
+        self.insert(id, fields)
+        return id
+
+    # Store a todo under a given id (used when restoring a snapshot or replaying a log).
+    def insert(self, id, fields):
+        todo = Todo(**{key: fields[key] for key in FIELDS + ('version',) if key in fields})
+        if id not in self.todos:
+            # New ids are the largest, except when restoring out of order
+            if not self.id_list or id > self.id_list[-1]:
+                self.id_list.append(id)
+            else:
+                bisect.insort(self.id_list, id)
+        self.todos[id] = todo
+        self.next_id = max(self.next_id, id + 1)
+        self.index_tags(id, todo.tags)
+        return todo
+
+    def patch(self, id, fields):
+        todo = self.todos[id]
+        if 'tags' in fields:
+            self.unindex_tags(id, todo.tags)
+            todo.tags = tuple(sys.intern(tag) for tag in fields['tags'])
+            self.index_tags(id, todo.tags)
+        for key in ('title', 'order', 'completed'):
+            if key in fields:
+                setattr(todo, key, fields[key])
+        todo.version += 1
+        self.encoded.pop(id, None)
+
+    def delete(self, id):
+        self.unindex_tags(id, self.todos[id].tags)
+        del self.todos[id]
+        del self.id_list[bisect.bisect_left(self.id_list, id)]
+        self.encoded.pop(id, None)
+
+    # Remove every todo. The id counter is kept, so ids are never reused.
+    def clear(self):
+        self.todos.clear()
+        self.id_list.clear()
+        self.tag_index.clear()
+        self.encoded.clear()
+
+    # A todo can list a tag twice, its id is indexed once.
+    def index_tags(self, id, tags):
+        for tag in set(tags):
+            ids = self.tag_index.setdefault(tag, [])
+            if not ids or id > ids[-1]:
+                ids.append(id)
+            else:
+                index = bisect.bisect_left(ids, id)
+                if index == len(ids) or ids[index] != id:
+                    ids.insert(index, id)
+
+    def unindex_tags(self, id, tags):
+        for tag in set(tags):
+            ids = self.tag_index.get(tag)
+            if ids is not None:
+                index = bisect.bisect_left(ids, id)
+                if index < len(ids) and ids[index] == id:
+                    del ids[index]
+                if not ids:
+                    del self.tag_index[tag]
+
+    # The ids greater than `after` of the todos having any (match=any) or all (match=all)
+    # of the given tags, in ascending order and at most `count` of them (all of them with
+    # None). Every tag's ids are read from the cursor on, and only until `count` ids are
+    # found, instead of collecting and sorting every matching id for each page.
+    def ids_for_tags(self, tags, match='any', after=-1, count=None):
+        lists = [self.tag_index.get(tag, []) for tag in tags]
+        if not lists:
+            return []
+        tails = [itertools.islice(ids, bisect.bisect_right(ids, after), None) for ids in lists]
+        if match == 'all':
+            # Walk the shortest list, keeping the todos that also have the other tags
+            tail = min(zip(lists, tails), key=lambda pair: len(pair[0]))[1]
+            found = (id for id in tail if all(tag in self.todos[id].tags for tag in tags))
+        else:
+            # The lists merged in order, an id carrying several of the tags once
+            found = (id for id, _ in itertools.groupby(heapq.merge(*tails)))
+        return list(itertools.islice(found, count))
+
+    def to_dict(self, id):
+        todo = self.todos[id]
+        return {
+            'id': id,
+            'title': todo.title,
+            'order': todo.order,
+            'completed': todo.completed,
+            'tags': list(todo.tags),
+            'version': todo.version,
+        }
+
+    # The JSON encoding of a todo without its closing brace, so that the caller can
+    # append the url.
+    def encode(self, id):
+        if not self.json_cache:
+            return json.dumps(self.to_dict(id)).encode()[:-1]
+        encoded = self.encoded.get(id)
+        if encoded is None:
+            encoded = self.encoded[id] = json.dumps(self.to_dict(id)).encode()[:-1]
+            self.cache_stats['rebuilds'] += 1
+        else:
+            self.cache_stats['hits'] += 1
+        return encoded
+
+    def snapshot(self):
+        return {
+            'next_id': self.next_id,
+            'todos': [self.to_dict(id) for id in self.todos],
+        }
+
+    def restore(self, snapshot):
+        self.clear()
+        for todo in snapshot['todos']:
+            self.insert(todo['id'], todo)
+        self.next_id = max(self.next_id, snapshot['next_id'])